@@ -1,22 +1,55 @@
+import time
+STARTUP_T0 = time.perf_counter() # Taken before the heavy imports so --startup-profile includes them
 import customtkinter as ctk
 import tkinter as tk
-from tkinter import simpledialog, messagebox, font as tkfont
-import google.generativeai as genai
+from tkinter import simpledialog, messagebox, filedialog, font as tkfont
 import threading
+import asyncio
 import queue
 import os
+import sys
 import configparser
-from PIL import Image, ImageTk, UnidentifiedImageError
+import contextlib
+import argparse
 import base64
 import io
 import json
 import datetime
+import itertools
+import sqlite3
+import hashlib
+import re
+import bisect
+import collections
+import random
+import http.client
+import http.server
+import urllib.parse
+import concurrent.futures
+import zipfile
+import tempfile
+import statistics
+import subprocess
+import logging.handlers
+import math
+import zlib
+
+genai = None # google.generativeai, imported lazily off the UI thread by import_genai()
+numpy = None # Optional, imported lazily by import_numpy(); False once it is known to be missing
 
 # --- Configuration ---
 APP_NAME = "Gemini Chat GUI"
 CONFIG_DIR = os.path.expanduser(f"~/.config/{APP_NAME.lower().replace(' ', '_')}")
 CHATS_DIR = os.path.join(CONFIG_DIR, "chats")
+CACHE_DIR = os.path.join(CONFIG_DIR, "response_cache")
+CHAT_EXTENSION = ".jsonl" # Append-only log, one message per line
+LEGACY_CHAT_EXTENSION = ".json" # Whole-history JSON array, still readable
+CHAT_EXTENSIONS = (CHAT_EXTENSION, LEGACY_CHAT_EXTENSION)
 CONFIG_FILE = os.path.join(CONFIG_DIR, "config.ini")
+CATALOG_FILE = os.path.join(CONFIG_DIR, "catalog.sqlite3")
+ARCHIVE_FILE = os.path.join(CONFIG_DIR, "archive.zip")
+STALL_LOG_FILE = os.path.join(CONFIG_DIR, "stalls.log")
+RETRIEVAL_DIR = os.path.join(CONFIG_DIR, "retrieval")
 
 API_SECTION = "API"
 API_KEY_OPTION = "google_api_key"
@@ -24,9 +57,114 @@ SETTINGS_SECTION = "Settings"
 APPEARANCE_OPTION = "appearance_mode"
 THEME_OPTION = "color_theme"
 MODEL_OPTION = "gemini_model"
+FRAME_BUDGET_OPTION = "frame_budget_ms"
+AUTOSAVE_OPTION = "autosave_delay_ms"
+CONTEXT_BUDGET_OPTION = "context_token_budget"
+RESPONSE_CACHE_OPTION = "response_cache"
+BACKEND_OPTION = "backend"
+MOCK_URL_OPTION = "mock_server_url"
+MOCK_SECTION = "MockServer"
+RESPONSE_CACHE_SIZE_OPTION = "response_cache_mb"
+REQUESTS_PER_MINUTE_OPTION = "requests_per_minute"
+METRICS_FILE_OPTION = "metrics_file"
+ARCHIVE_AGE_OPTION = "archive_after_days"
+STALL_THRESHOLD_OPTION = "stall_threshold_ms"
+RETRIEVAL_OPTION = "retrieval"
+RETRIEVAL_BUDGET_OPTION = "retrieval_token_budget"
 
 DEFAULT_MODEL = "gemini-1.5-flash"
 AVAILABLE_MODELS = ["gemini-1.5-flash", "gemini-pro"]
+MODEL_CONTEXT_LIMITS = {"gemini-1.5-flash": 1048576, "gemini-pro": 30720} # Input tokens accepted per request
+DEFAULT_CONTEXT_TOKEN_BUDGET = 32000 # History tokens sent per request; older turns are summarized
+RESPONSE_TOKEN_RESERVE = 2048 # Kept free below the model limit for the reply
+CHARS_PER_TOKEN = 4 # Offline token estimate, close enough for budgeting
+DEFAULT_RESPONSE_CACHE_MB = 64
+DEFAULT_ARCHIVE_AFTER_DAYS = 30 # Chats untouched this long move to the compressed archive; 0 disables
+DEFAULT_RETRIEVAL_TOKEN_BUDGET = 800 # Tokens of past-chat snippets attached to a prompt when retrieval is on
+
+DEFAULT_BACKEND = "gemini"
+AVAILABLE_BACKENDS = ["gemini", "mock"]
+DEFAULT_MOCK_PORT = 8765
+# Streaming behavior of the local stand-in server; overridable in [MockServer] or on the command line
+DEFAULT_MOCK_PROFILE = {
+    "ttft_ms": 400, # Delay before the first chunk
+    "tokens_per_sec": 60,
+    "chunk_tokens": 4, # Words per streamed chunk
+    "response_tokens": 120, # Words per reply
+    "error_rate": 0.0, # Fraction of requests failing with a 500
+    "quota_rate": 0.0, # Fraction of requests rejected with a 429
+    "retry_after": 2, # Seconds suggested by 429 responses
+}
+
+SAFETY_SETTINGS = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+]
+
+DEFAULT_FRAME_BUDGET_MS = 16 # Max time spent draining the UI queue per frame
+QUEUE_POLL_MS = 10 # Wakeup check interval where Tk can't watch the wakeup pipe (Windows)
+QUEUE_IDLE_POLL_MS = 500 # Safety net in case a wakeup is lost
+DEFAULT_AUTOSAVE_DELAY_MS = 2000 # Quiet period before a saved chat's new turns are written; 0 disables
+REQUEST_QUEUE_LIMIT = 8 # Pending chat requests accepted before new sends are refused
+JOB_PRIORITY_HIGH = 0 # API configuration and session switches run before queued requests
+JOB_PRIORITY_NORMAL = 10
+MAX_CONCURRENT_REPLIES = 8 # Replies streamed at once across all tabs; further sends wait for a slot
+MODEL_POOL_SIZE = 4 # Live model objects kept for the configured backend and key
+SESSION_POOL_SIZE = 16 # Closed chats kept live so reopening them skips reading and parsing
+SESSION_POOL_MB = 32 # Estimated text held by those chats
+MESSAGE_MEMORY_MB = 256 # Messages held by open tabs and pooled chats together; pooled chats give way first
+DEFAULT_REQUESTS_PER_MINUTE = 15 # Per model and API key; quota errors lower it temporarily
+REQUEST_BURST = 3 # Requests allowed back to back before the rate applies
+MIN_RATE_FRACTION = 0.1 # Quota errors never slow a model below this share of its rate
+MAX_QUOTA_RETRIES = 5
+RETRY_BASE_DELAY = 1.0 # Seconds; doubled per attempt, with jitter
+RETRY_MAX_DELAY = 60.0
+METRICS_PREFIX = "gemini_chat_"
+LATENCY_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+TOKEN_RATE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+FSYNC_BATCH_WINDOW = 0.05 # Seconds the chat writer waits to batch more writes into one fsync
+DEFAULT_STALL_THRESHOLD_MS = 200 # Event-loop lag that counts as a stall and gets sampled; 0 disables
+STALL_HEARTBEAT_MS = 50 # Interval of the Tk timer whose lateness measures loop lag
+STALL_SAMPLE_INTERVAL_MS = 5 # Main-thread stack sampling period while a stall lasts
+STALL_TOP_FRAMES = 10 # Hottest frames listed per stall report
+STALL_LOG_MAX_BYTES = 1024 * 1024 # stalls.log is rotated past this size
+STALL_LOG_BACKUPS = 3
+
+TRANSCRIPT_PAGE_SIZE = 50 # Messages materialized per page of the transcript
+TRANSCRIPT_MAX_PAGES = 4 # Pages kept in the text widget before the farthest one is released
+LOAD_BATCH_SIZE = 500 # Older messages parsed and handed to the UI per step while a chat loads
+MARKDOWN_CACHE_SIZE = 5000 # Rendered replies kept, so paging and reopening chats skips parsing
+MARKDOWN_CACHE_MB = 16
+RETRIEVAL_DIMENSIONS = 2048 # Hashed feature slots per snippet vector, stored as float16
+RETRIEVAL_SNIPPET_CHARS = 600 # Saved messages are indexed in pieces of about this size
+RETRIEVAL_TOP_K = 5 # Most snippets attached to one prompt
+RETRIEVAL_MIN_SCORE = 0.15 # Cosine similarity below which a snippet is not worth its tokens
+RETRIEVAL_BATCH_SIZE = 2000 # Catalog messages embedded per step of an index update
+
+CHAT_LIST_ROW_HEIGHT = 30 # Height of one recycled sidebar row, including padding
+ARCHIVE_PAGE_SIZE = 100 # Archived chats added to the sidebar each time its end is reached
+CATALOG_BATCH_SIZE = 20 # Chats parsed per catalog transaction while reconciling, so readers wait briefly
+
+DEFAULT_BATCH_CONCURRENCY = 4
+
+BENCHMARK_CHAT_COUNTS = (1000, 10000, 100000) # Sizes of the synthetic CHATS_DIR trees
+BENCHMARK_TURN_COUNTS = (1000, 10000, 100000) # Sizes of the synthetic single chats
+BENCHMARK_DISPLAY_MESSAGES = 200 # Messages appended through display_message per run
+BENCHMARK_TOLERANCE = 0.25 # Slowdown against a baseline run that counts as a regression
+BENCHMARK_NOISE_MS = 5 # Never flag a difference smaller than this
+# Budget per benchmark as (fixed ms, ms per chat or turn); exceeding it fails even without a baseline
+BENCHMARK_BUDGETS_MS = {
+    "catalog_reconcile": (1000, 1.0),
+    "get_chat_files": (20, 0.005),
+    "load_chat_list": (100, 0.005),
+    "save_chat_to_file.compact": (100, 0.1), # Includes the writer's fsync and search indexing
+    "save_chat_to_file.append": (150, 0.0), # Includes the writer's FSYNC_BATCH_WINDOW
+    "load_chat_from_file": (20, 0.02),
+    "transcript_load": (200, 0.005),
+    "display_message": (1000, 0.0),
+}
 
 SIDEBAR_WIDTH = 200
 TOGGLE_BUTTON_WIDTH = 20 # Reduced width
@@ -36,7 +174,26 @@ ICON_PLACEHOLDER_B64 = "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR4
 SEND_ICON_B64 = ICON_PLACEHOLDER_B64
 
 # --- Helper Functions ---
+def import_genai():
+    global genai
+    if genai is None:
+        import google.generativeai
+        genai = google.generativeai
+    return genai
+
+def import_numpy():
+    # Only the retrieval index needs NumPy; returns None when it isn't installed
+    global numpy
+    if numpy is None:
+        try:
+            import numpy as np
+            numpy = np
+        except ImportError:
+            numpy = False
+    return numpy or None
+
 def load_icon(base64_string, size=(20, 20)):
+    from PIL import Image, UnidentifiedImageError # Only needed for icons, not at import time
     image = None
     try:
         cleaned_b64 = "".join(base64_string.strip().split())
@@ -49,6 +206,30 @@ def load_icon(base64_string, size=(20, 20)):
     except Exception: pass
     return None
 
+class StartupProfile:
+    # Collects per-stage timings for --startup-profile; a no-op unless enabled.
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+
+    def record(self, stage, started, finished=None):
+        if not self.enabled: return
+        finished = time.perf_counter() if finished is None else finished
+        with self.lock:
+            print(f"[startup] {stage:<20} at {(started - STARTUP_T0) * 1000:8.1f} ms  took {(finished - started) * 1000:8.1f} ms",
+                  file=sys.stderr, flush=True)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try: yield
+        finally: self.record(name, started)
+
+    def mark(self, name):
+        self.record(name, time.perf_counter())
+
+startup_profile = StartupProfile()
+
 def ensure_config_dir():
     os.makedirs(CONFIG_DIR, exist_ok=True)
 
@@ -63,8 +244,22 @@ def load_config():
     config[SETTINGS_SECTION] = {
         APPEARANCE_OPTION: 'System',
         THEME_OPTION: 'blue',
-        MODEL_OPTION: DEFAULT_MODEL
+        MODEL_OPTION: DEFAULT_MODEL,
+        FRAME_BUDGET_OPTION: str(DEFAULT_FRAME_BUDGET_MS),
+        AUTOSAVE_OPTION: str(DEFAULT_AUTOSAVE_DELAY_MS),
+        CONTEXT_BUDGET_OPTION: str(DEFAULT_CONTEXT_TOKEN_BUDGET),
+        RESPONSE_CACHE_OPTION: 'false',
+        RESPONSE_CACHE_SIZE_OPTION: str(DEFAULT_RESPONSE_CACHE_MB),
+        REQUESTS_PER_MINUTE_OPTION: str(DEFAULT_REQUESTS_PER_MINUTE),
+        METRICS_FILE_OPTION: '', # Metrics are written here on exit (.json, otherwise Prometheus text)
+        ARCHIVE_AGE_OPTION: str(DEFAULT_ARCHIVE_AFTER_DAYS),
+        STALL_THRESHOLD_OPTION: str(DEFAULT_STALL_THRESHOLD_MS),
+        RETRIEVAL_OPTION: 'false',
+        RETRIEVAL_BUDGET_OPTION: str(DEFAULT_RETRIEVAL_TOKEN_BUDGET),
+        BACKEND_OPTION: DEFAULT_BACKEND,
+        MOCK_URL_OPTION: '' # Blank starts an in-process mock server
     }
+    config[MOCK_SECTION] = {option: str(value) for option, value in DEFAULT_MOCK_PROFILE.items()}
     config.read(CONFIG_FILE)
     return config
 
@@ -80,56 +275,2431 @@ def save_config(config):
         messagebox.showerror("Save Error", f"Could not save config to {CONFIG_FILE}.")
         return False
 
+# --- Chat Catalog ---
+class ChatCatalog:
+    # Persistent per-chat metadata index next to CHATS_DIR, so listing and sorting
+    # chats is one indexed query instead of a directory scan plus a stat per file.
+    # Message text is kept in an FTS5 inverted index for search across all chats.
+    def __init__(self, path=CATALOG_FILE):
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS chats (
+                    filename TEXT PRIMARY KEY,
+                    title TEXT NOT NULL,
+                    message_count INTEGER NOT NULL DEFAULT 0,
+                    created REAL NOT NULL,
+                    modified REAL NOT NULL,
+                    size INTEGER NOT NULL DEFAULT 0,
+                    archived INTEGER NOT NULL DEFAULT 0
+                )""")
+            if "archived" not in {row[1] for row in self.conn.execute("PRAGMA table_info(chats)")}:
+                self.conn.execute("ALTER TABLE chats ADD COLUMN archived INTEGER NOT NULL DEFAULT 0")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS chats_by_modified ON chats(modified DESC)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS chats_by_archived ON chats(archived, modified DESC)")
+            self.search_enabled = self._create_search_index()
+
+    def _create_search_index(self):
+        exists = self.conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone()
+        try:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY,
+                    filename TEXT NOT NULL,
+                    turn INTEGER NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL
+                )""")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS messages_by_chat ON messages(filename, turn)")
+            self.conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(content, content='messages', content_rowid='id')")
+            self.conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+                    INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+                END""")
+            self.conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN
+                    INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+                END""")
+        except sqlite3.OperationalError: # SQLite built without FTS5
+            return False
+        if not exists: self.conn.execute("DELETE FROM chats") # Re-read every chat once to fill the new index
+        return True
+
+    def list_files(self):
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT filename FROM chats WHERE archived = 0 ORDER BY modified DESC")]
+
+    def list_archived(self, offset=0, limit=ARCHIVE_PAGE_SIZE):
+        with self.lock:
+            return [row[0] for row in self.conn.execute(
+                "SELECT filename FROM chats WHERE archived = 1 ORDER BY modified DESC LIMIT ? OFFSET ?", (limit, offset))]
+
+    def list_unmodified_since(self, cutoff):
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT filename FROM chats WHERE archived = 0 AND modified < ?", (cutoff,))]
+
+    def set_archived(self, filenames):
+        with self.lock, self.conn:
+            self.conn.executemany("UPDATE chats SET archived = 1 WHERE filename = ?", [(name,) for name in filenames])
+
+    def mark_deleted(self, filename):
+        # archived = 2 is a tombstone for a deleted chat whose member is still in the archive,
+        # so reconcile doesn't bring it back before the next archive rewrite drops the member
+        with self.lock, self.conn:
+            self._delete(filename)
+            self._upsert(filename, 0, time.time(), 0, archived=2)
+
+    def is_deleted(self, filename):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM chats WHERE filename = ? AND archived = 2", (filename,)).fetchone() is not None
+
+    def list_deleted(self):
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT filename FROM chats WHERE archived = 2")]
+
+    def forget_deleted(self, filenames):
+        with self.lock, self.conn:
+            self.conn.executemany("DELETE FROM chats WHERE filename = ? AND archived = 2", [(name,) for name in filenames])
+
+    def get(self, filename):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT filename, title, message_count, created, modified, size, archived FROM chats WHERE filename = ?", (filename,)
+            ).fetchone()
+        return dict(zip(("filename", "title", "message_count", "created", "modified", "size", "archived"), row)) if row else None
+
+    def record(self, file_path, message_count, records=(), first_turn=0):
+        # first_turn == 0 means records is the whole chat and replaces what was indexed
+        stat = os.stat(file_path)
+        filename = os.path.basename(file_path)
+        with self.lock, self.conn:
+            self._upsert(filename, message_count, stat.st_mtime, stat.st_size)
+            self._index_messages(filename, records, first_turn)
+
+    def remove(self, file_path):
+        with self.lock, self.conn:
+            self._delete(os.path.basename(file_path))
+
+    def search(self, query, limit=50):
+        terms = ['"' + term.replace('"', '""') + '"' for term in query.split()]
+        if not self.search_enabled or not terms: return []
+        terms[-1] += "*" # Prefix match the word still being typed
+        with self.lock:
+            rows = self.conn.execute("""
+                SELECT m.filename, c.title, m.turn, m.role, snippet(messages_fts, 0, '', '', '...', 12)
+                FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid JOIN chats c ON c.filename = m.filename
+                WHERE messages_fts MATCH ? ORDER BY bm25(messages_fts) LIMIT ?""", (" ".join(terms), limit)).fetchall()
+        return [dict(zip(("filename", "title", "turn", "role", "snippet"), row)) for row in rows]
+
+    def count_messages(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0] if self.search_enabled else 0
+
+    def messages_after(self, last_id, limit):
+        # Indexed messages in insertion order, for consumers that follow the table incrementally
+        if not self.search_enabled: return []
+        with self.lock:
+            return self.conn.execute("SELECT id, content FROM messages WHERE id > ? ORDER BY id LIMIT ?", (last_id, limit)).fetchall()
+
+    def get_messages(self, ids):
+        if not self.search_enabled or not ids: return {}
+        with self.lock:
+            rows = self.conn.execute(f"""
+                SELECT m.id, m.filename, c.title, m.turn, m.role, m.content FROM messages m JOIN chats c ON c.filename = m.filename
+                WHERE m.id IN ({",".join("?" * len(ids))})""", list(ids)).fetchall()
+        return {row[0]: dict(zip(("filename", "title", "turn", "role", "content"), row[1:])) for row in rows}
+
+    def reconcile(self, directory=CHATS_DIR, archive=None):
+        # One directory pass at startup; only new or changed files are parsed. Parsing
+        # happens outside the lock and rows are written in small batches, so UI-thread
+        # queries wait for one batch at most, not for the whole pass.
+        on_disk = {}
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.endswith(CHAT_EXTENSIONS):
+                    stat = entry.stat()
+                    on_disk[entry.name] = (stat.st_mtime, stat.st_size)
+        with self.lock:
+            known = {name: (modified, size) for name, modified, size in
+                     self.conn.execute("SELECT filename, modified, size FROM chats WHERE archived = 0")}
+            with self.conn:
+                for name in known.keys() - on_disk.keys(): self._delete(name)
+        changed = [name for name, stat in on_disk.items() if known.get(name) != stat]
+        for start in range(0, len(changed), CATALOG_BATCH_SIZE):
+            parsed = []
+            for name in changed[start:start + CATALOG_BATCH_SIZE]:
+                try: records = read_chat_records(os.path.join(directory, name))
+                except (IOError, ValueError, KeyError, TypeError): records = []
+                parsed.append((name, records))
+            with self.lock, self.conn:
+                for name, records in parsed:
+                    if self._live_stat(name) != known.get(name): continue # Saved meanwhile; the writer recorded it
+                    modified, size = on_disk[name]
+                    self._upsert(name, len(records), modified, size)
+                    self._index_messages(name, records, 0)
+        if archive: self._reconcile_archive(archive)
+
+    def _reconcile_archive(self, archive):
+        # Archived rows follow the archive's own index; members are only parsed when the catalog was rebuilt
+        try: members = archive.members()
+        except (OSError, zipfile.BadZipFile): return
+        with self.lock:
+            archived = {row[0] for row in self.conn.execute("SELECT filename FROM chats WHERE archived IN (1, 2)")}
+            known = {row[0] for row in self.conn.execute("SELECT filename FROM chats")} # Tombstones included
+            with self.conn:
+                for name in archived - members.keys(): self._delete(name)
+        missing = sorted(members.keys() - known)
+        for start in range(0, len(missing), CATALOG_BATCH_SIZE):
+            parsed = []
+            for name in missing[start:start + CATALOG_BATCH_SIZE]:
+                try: records = parse_chat_records(name, archive.read(name))
+                except (OSError, zipfile.BadZipFile, ValueError, KeyError, TypeError): records = []
+                parsed.append((name, records))
+            with self.lock, self.conn:
+                for name, records in parsed:
+                    if self.conn.execute("SELECT 1 FROM chats WHERE filename = ?", (name,)).fetchone(): continue # Saved or deleted meanwhile
+                    modified, size = members[name]
+                    self._upsert(name, len(records), modified, size, archived=1)
+                    self._index_messages(name, records, 0)
+
+    def _live_stat(self, filename):
+        row = self.conn.execute("SELECT modified, size FROM chats WHERE filename = ? AND archived = 0", (filename,)).fetchone()
+        return tuple(row) if row else None
+
+    def _upsert(self, filename, message_count, modified, size, archived=0):
+        title = os.path.splitext(filename)[0].replace('_', ' ')
+        self.conn.execute("""
+            INSERT INTO chats (filename, title, message_count, created, modified, size, archived) VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(filename) DO UPDATE SET
+                title = excluded.title, message_count = excluded.message_count,
+                modified = excluded.modified, size = excluded.size, archived = excluded.archived""",
+            (filename, title, message_count, modified, modified, size, archived))
+
+    def _delete(self, filename):
+        self.conn.execute("DELETE FROM chats WHERE filename = ?", (filename,))
+        if self.search_enabled: self.conn.execute("DELETE FROM messages WHERE filename = ?", (filename,))
+
+    def _index_messages(self, filename, records, first_turn):
+        if not self.search_enabled: return
+        if first_turn == 0: self.conn.execute("DELETE FROM messages WHERE filename = ?", (filename,))
+        else: self.conn.execute("DELETE FROM messages WHERE filename = ? AND turn >= ?", (filename, first_turn))
+        self.conn.executemany(
+            "INSERT INTO messages (filename, turn, role, content) VALUES (?, ?, ?, ?)",
+            [(filename, first_turn + i, record['role'], record['content']) for i, record in enumerate(records)])
+
+_catalog = None
+
+def get_catalog():
+    global _catalog
+    if _catalog is None:
+        ensure_config_dir()
+        try: _catalog = ChatCatalog()
+        except sqlite3.Error: return None
+    return _catalog
+
+def read_chat_records(file_path):
+    return parse_chat_records(file_path, read_chat_bytes(file_path))
+
+def parse_chat_records(file_path, data):
+    records = []
+    if file_path.endswith(CHAT_EXTENSION):
+        for line in data.split(b"\n"):
+            if not line.strip(): continue
+            try: item = json.loads(line)
+            except json.JSONDecodeError: continue # Torn write from a crash
+            records.append({'role': item['role'], 'content': item['content']})
+    else:
+        for item in json.loads(data):
+            records.append({'role': item['role'], 'content': item['content']})
+    return records
+
+def read_chat_bytes(file_path):
+    # The live file if there is one, otherwise the chat's member in the archive
+    try:
+        with open(file_path, 'rb') as f: return f.read()
+    except FileNotFoundError:
+        data = get_archive().read(os.path.basename(file_path))
+        if data is None: raise
+        return data
+
+def chat_exists(file_path):
+    if os.path.exists(file_path): return True
+    filename = os.path.basename(file_path)
+    if not get_archive().contains(filename): return False
+    catalog = get_catalog()
+    try: return not (catalog and catalog.is_deleted(filename))
+    except sqlite3.Error: return True
+
+# --- Chat Writer ---
+class ChatWriter:
+    # Write-behind persistence for chat logs. Appends and compactions are queued from
+    # the UI thread and applied on one background thread, batching fsyncs per file.
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.on_error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def append(self, file_path, records, message_count):
+        self.queue.put(("append", file_path, records, message_count))
+
+    def compact(self, file_path, records):
+        self.queue.put(("compact", file_path, records, len(records)))
+
+    def flush(self, timeout=None):
+        done = threading.Event()
+        self.queue.put(("flush", None, done, None))
+        return done.wait(timeout)
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + FSYNC_BATCH_WINDOW
+            while True:
+                try: batch.append(self.queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty: break
+            open_logs = {}
+            waiters = []
+            for op, file_path, payload, message_count in batch:
+                if op == "flush":
+                    waiters.append(payload)
+                    continue
+                try:
+                    if op == "append":
+                        log = open_logs.get(file_path)
+                        if log is None: log = open_logs[file_path] = self._open_log(file_path)
+                        log.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in payload))
+                    else:
+                        log = open_logs.pop(file_path, None)
+                        if log: self._close_log(log)
+                        self._write_atomic(file_path, payload)
+                    self._record(file_path, message_count, payload, message_count - len(payload))
+                except (OSError, TypeError, ValueError) as e:
+                    self._report(f"Failed to save chat: {e}")
+            for log in open_logs.values():
+                try: self._close_log(log)
+                except OSError as e: self._report(f"Failed to save chat: {e}")
+            for done in waiters: done.set()
+
+    def _open_log(self, file_path):
+        log = open(file_path, 'a+', encoding='utf-8')
+        if log.tell() > 0:
+            log.seek(log.tell() - 1)
+            if log.read(1) != "\n": log.write("\n") # Seal a line torn by an earlier crash
+        return log
+
+    def _close_log(self, log):
+        log.flush()
+        os.fsync(log.fileno())
+        log.close()
+
+    def _write_atomic(self, file_path, records):
+        tmp_path = file_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for record in records: f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+        legacy_path = os.path.splitext(file_path)[0] + LEGACY_CHAT_EXTENSION
+        if file_path != legacy_path and chat_exists(legacy_path):
+            if os.path.exists(legacy_path): os.remove(legacy_path) # Migrated to the append-only format
+            catalog = get_catalog()
+            if catalog:
+                try:
+                    filename = os.path.basename(legacy_path)
+                    if get_archive().contains(filename): catalog.mark_deleted(filename) # Or reconcile revives it
+                    else: catalog.remove(legacy_path)
+                except sqlite3.Error: pass
+
+    def _record(self, file_path, message_count, records, first_turn):
+        catalog = get_catalog()
+        if catalog:
+            try: catalog.record(file_path, message_count, records, first_turn)
+            except (OSError, sqlite3.Error): pass # Reconciled on next startup
+
+    def _report(self, message):
+        if self.on_error: self.on_error(message)
+
+_chat_writer = None
+_chat_files_lock = threading.Lock() # Saves pick append vs rewrite under it; archiving removes live files under it
+
+def get_chat_writer():
+    global _chat_writer
+    if _chat_writer is None: _chat_writer = ChatWriter()
+    return _chat_writer
+
+# --- Chat Archive ---
+class ChatArchive:
+    # Cold storage for chats nobody has touched in a while: one deflated member per
+    # chat in a zip file. The zip's central directory is the index, so reading one
+    # chat seeks straight to its member without decompressing any of the others.
+    def __init__(self, path=ARCHIVE_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.reader = None # Open ZipFile, reused across reads until the archive is rewritten
+
+    def _open(self):
+        if self.reader is None:
+            if not os.path.exists(self.path): return None
+            self.reader = zipfile.ZipFile(self.path)
+        return self.reader
+
+    def _close(self):
+        if self.reader:
+            self.reader.close()
+            self.reader = None
+
+    def members(self):
+        with self.lock:
+            reader = self._open()
+            if reader is None: return {}
+            return {info.filename: (time.mktime(info.date_time + (0, 0, -1)), info.file_size) for info in reader.infolist()}
+
+    def contains(self, filename):
+        with self.lock:
+            try: reader = self._open()
+            except (OSError, zipfile.BadZipFile): return False
+            return reader is not None and filename in reader.NameToInfo
+
+    def read(self, filename):
+        with self.lock:
+            reader = self._open()
+            if reader is None or filename not in reader.NameToInfo: return None
+            return reader.read(filename)
+
+    def add(self, file_paths, keep):
+        # Members not in keep (deleted, or live again) and members being replaced are
+        # dropped by rewriting the archive; otherwise new chats are simply appended.
+        names = {os.path.basename(path) for path in file_paths}
+        with self.lock:
+            reader = self._open()
+            existing = set(reader.NameToInfo) if reader else set()
+            self._close()
+            if existing - (keep - names):
+                tmp_path = self.path + ".tmp"
+                with zipfile.ZipFile(self.path) as old, zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as new:
+                    for info in old.infolist():
+                        if info.filename in keep and info.filename not in names: new.writestr(info, old.read(info))
+                    for path in file_paths: new.write(path, os.path.basename(path))
+                os.replace(tmp_path, self.path)
+            elif file_paths:
+                with zipfile.ZipFile(self.path, 'a', zipfile.ZIP_DEFLATED) as archive:
+                    for path in file_paths: archive.write(path, os.path.basename(path))
+
+    def remove(self, filename):
+        self.add([], set(self.members()) - {filename})
+
+_archive = None
+
+def get_archive():
+    global _archive
+    if _archive is None: _archive = ChatArchive()
+    return _archive
+
+def archive_old_chats(max_age_days, is_open=lambda filename: False):
+    # Moves chats not modified for max_age_days from CHATS_DIR into the archive, and drops
+    # the members of archived chats deleted since the last run. is_open is asked again
+    # right before each file is removed, since chats can be opened meanwhile.
+    catalog = get_catalog()
+    if not catalog: return 0
+    flush_chat_writes(timeout=5)
+    try:
+        deleted = catalog.list_deleted()
+        old = [name for name in catalog.list_unmodified_since(time.time() - max_age_days * 86400) if not is_open(name)] if max_age_days > 0 else []
+        copied = {} # Path -> (mtime, size) when it was copied into the archive
+        for name in old:
+            try: stat = os.stat(os.path.join(CHATS_DIR, name))
+            except FileNotFoundError: continue
+            copied[os.path.join(CHATS_DIR, name)] = (stat.st_mtime_ns, stat.st_size)
+        if not copied and not deleted: return 0
+        get_archive().add(list(copied), set(catalog.list_archived(limit=-1))) # Tombstoned members aren't kept
+        catalog.forget_deleted(deleted)
+    except (OSError, zipfile.BadZipFile, sqlite3.Error): return 0
+    moved = []
+    with _chat_files_lock: # Saves can't choose to append to these files while they go
+        if not flush_chat_writes(timeout=5): return 0 # A late append could recreate a file with only its new turns
+        for path, copied_stat in copied.items():
+            try:
+                stat = os.stat(path)
+                if is_open(os.path.basename(path)) or (stat.st_mtime_ns, stat.st_size) != copied_stat: continue # Member is stale; dropped next rewrite
+                os.remove(path)
+            except OSError: continue
+            moved.append(os.path.basename(path))
+    try: catalog.set_archived(moved)
+    except sqlite3.Error: pass # Reconciled on next startup
+    return len(moved)
+
 # --- Chat History Handling ---
 def get_chat_files():
     ensure_chats_dir()
+    catalog = get_catalog()
+    if catalog:
+        try: return catalog.list_files()
+        except sqlite3.Error: pass
     try:
-        files = [f for f in os.listdir(CHATS_DIR) if f.endswith('.json')]
+        files = [f for f in os.listdir(CHATS_DIR) if f.endswith(CHAT_EXTENSIONS)]
         files.sort(key=lambda x: os.path.getmtime(os.path.join(CHATS_DIR, x)), reverse=True)
         return files
     except OSError:
         return []
 
-def save_chat_to_file(chat_history, file_path):
+def reconcile_chat_catalog():
+    ensure_chats_dir()
+    catalog = get_catalog()
+    if not catalog: return
+    try: catalog.reconcile(CHATS_DIR, get_archive())
+    except (OSError, sqlite3.Error): pass
+
+def message_role(msg):
+    return msg['role'] if isinstance(msg, dict) else getattr(msg, 'role', '')
+
+def message_text(msg):
+    if isinstance(msg, Message): return msg.text
+    if isinstance(msg, dict):
+        if 'content' in msg: return msg['content']
+        return "".join(part.get('text', '') for part in msg.get('parts', []) if isinstance(part, dict))
+    return "".join(part.text for part in getattr(msg, 'parts', []) if hasattr(part, 'text'))
+
+def serialize_chat_history(chat_history):
+    return [{'role': message_role(msg), 'content': message_text(msg)} for msg in chat_history if message_role(msg)]
+
+def chat_save_path(file_path):
+    # Legacy JSON arrays are never appended to or rewritten; saving one writes the
+    # append-only log beside it, and the writer removes the legacy file
+    root, extension = os.path.splitext(file_path)
+    return root + CHAT_EXTENSION if extension == LEGACY_CHAT_EXTENSION else file_path
+
+def save_chat_to_file(chat_history, file_path, append_from=None):
+    # Queues the write and returns immediately. With append_from, only the messages
+    # from that index on are appended; otherwise the log is atomically rewritten.
+    # Callers that keep the path should save to chat_save_path(file_path).
     ensure_chats_dir()
+    if chat_save_path(file_path) != file_path:
+        file_path, append_from = chat_save_path(file_path), None
     try:
-        serializable_history = []
-        for msg in chat_history:
-             try:
-                 text_content = "".join(part.text for part in msg.parts if hasattr(part, 'text'))
-                 serializable_history.append({'role': msg.role, 'content': text_content})
-             except AttributeError:
-                 if isinstance(msg, dict) and 'role' in msg and 'content' in msg:
-                      serializable_history.append(msg)
-                 else: pass # Skip unknown format
-
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(serializable_history, f, indent=2)
+        writer = get_chat_writer()
+        with _chat_files_lock:
+            if append_from is not None and os.path.exists(file_path):
+                writer.append(file_path, serialize_chat_history(chat_history[append_from:]), len(chat_history))
+            else:
+                writer.compact(file_path, serialize_chat_history(chat_history))
         return True
-    except (IOError, TypeError, AttributeError) as e:
+    except (TypeError, AttributeError, RuntimeError) as e:
         messagebox.showerror("Save Error", f"Failed to save chat: {e}")
         return False
 
 def load_chat_from_file(file_path):
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            history_data = json.load(f)
-        loaded_history = []
-        for item in history_data:
-             loaded_history.append({'role': item['role'], 'content': item['content']})
-        return loaded_history
-    except (IOError, json.JSONDecodeError, KeyError) as e:
+        return read_chat_records(file_path)
+    except (IOError, json.JSONDecodeError, KeyError, TypeError) as e:
         messagebox.showerror("Load Error", f"Failed to load chat: {e}")
         return None
 
+def flush_chat_writes(timeout=None):
+    if _chat_writer: return _chat_writer.flush(timeout)
+    return True
+
 def delete_chat_file(file_path):
     try:
-        os.remove(file_path)
+        flush_chat_writes(timeout=2) # Don't let a pending append recreate the file
+        filename = os.path.basename(file_path)
+        archived = get_archive().contains(filename) # Archived, or live again with a stale member
+        try: os.remove(file_path)
+        except FileNotFoundError:
+            if not archived: raise
+        catalog = get_catalog()
+        tombstoned = False
+        if archived and catalog:
+            try:
+                catalog.mark_deleted(filename) # The member is dropped at the next archive rewrite
+                tombstoned = True
+            except sqlite3.Error: pass
+        if archived and not tombstoned: get_archive().remove(filename) # Nothing would remember the deletion
+        elif not archived and catalog:
+            try: catalog.remove(file_path)
+            except sqlite3.Error: pass # Reconciled on next startup
         return True
-    except OSError as e:
+    except (OSError, zipfile.BadZipFile) as e:
         messagebox.showerror("Delete Error", f"Failed to delete chat file: {e}")
         return False
 
+def format_transcript_entry(message, tag="user", append_newlines=True):
+    prefix = ""
+    if tag == "user": prefix = "You: "
+    elif tag == "bot": prefix = "Gemini: "
+    elif tag == "error": prefix = "Error: "
+    elif tag == "info": prefix = "[INFO] "
+    segments = [(f"{prefix}{message}", tag)]
+    if append_newlines:
+        segments.append(("\n\n" if tag != "info" else "\n", None))
+    return segments
+
+# --- Message Store ---
+class Message:
+    # One turn of a conversation. A streaming reply collects its chunks in a list
+    # that is joined once, the first time the text is read.
+    __slots__ = ("role", "_text", "_chunks")
+
+    def __init__(self, role, text=""):
+        self.role = role
+        self._text = text
+        self._chunks = None
+
+    @property
+    def text(self):
+        if self._chunks is not None:
+            self._text = "".join(self._chunks)
+            self._chunks = None
+        return self._text
+
+    def append(self, chunk):
+        if self._chunks is None: self._chunks = [self._text] if self._text else []
+        self._chunks.append(chunk)
+
+    def nbytes(self):
+        return sys.getsizeof(self) + sys.getsizeof(self.text)
+
+    def to_api(self):
+        return {'role': self.role, 'parts': [{'text': self.text}]}
+
+class MessageStore:
+    # The single copy of a chat's messages: the transcript renders these objects, the
+    # chat writer saves them and each request builds its API history from them.
+    # Only the UI thread changes it; a request works on a snapshot of the list.
+    def __init__(self, messages=()):
+        self.messages = list(messages)
+        self.nbytes = sys.getsizeof(self.messages) + sum(msg.nbytes() for msg in self.messages)
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def __getitem__(self, index):
+        return self.messages[index]
+
+    def append(self, message):
+        self.messages.append(message)
+        self.nbytes += message.nbytes() + 8 # Plus its slot in the list
+        return message
+
+    def snapshot(self):
+        return list(self.messages)
+
+def api_history(messages):
+    return [msg.to_api() if isinstance(msg, Message) else msg for msg in messages]
+
+# --- Markdown Rendering ---
+MARKDOWN_FENCE = re.compile(r"\s*(`{3,}|~{3,})")
+MARKDOWN_HEADING = re.compile(r"(#{1,6})\s+(.*)")
+MARKDOWN_LIST_ITEM = re.compile(r"(\s*)([-*+]|\d+[.)])\s+(.*)")
+MARKDOWN_QUOTE = re.compile(r"\s*>\s?(.*)")
+MARKDOWN_INLINE = re.compile(r"`([^`]+)`|\*\*(.+?)\*\*|__(.+?)__|\*([^*\s](?:[^*]*[^*\s])?)\*")
+
+class MarkdownStream:
+    # Incremental Markdown renderer for one reply, producing (text, tags) segments for
+    # the Tk text widget. Complete lines are styled once and never revisited; only the
+    # trailing partial line is provisional and re-styled as more chunks arrive. The
+    # only state carried between lines is whether a code fence is open.
+    def __init__(self, base_tag="bot"):
+        self.base_tag = base_tag
+        self.partial = "" # Text after the last newline
+        self.fence = None # Opening fence marker while inside a code block
+        self.segments = [] # Final segments so far
+
+    def feed(self, text):
+        # Returns the segments that became final with this text
+        lines = (self.partial + text).split("\n")
+        self.partial = lines.pop()
+        start = len(self.segments)
+        for line in lines: self._line(line, "\n")
+        return self.segments[start:]
+
+    def finish(self):
+        start = len(self.segments)
+        if self.partial: self._line(self.partial, "")
+        self.partial = ""
+        return self.segments[start:]
+
+    def provisional(self):
+        if not self.partial: return []
+        return [(self.partial, (self.base_tag, "md_code_block") if self.fence else (self.base_tag,))]
+
+    def _line(self, line, end):
+        if self.fence is not None:
+            if line.strip().startswith(self.fence):
+                self.fence = None
+                self._add(line + end, "md_fence")
+            else: self._add(line + end, "md_code_block")
+            return
+        match = MARKDOWN_FENCE.match(line)
+        if match:
+            self.fence = match.group(1)
+            self._add(line + end, "md_fence")
+            return
+        block_tag = None
+        if MARKDOWN_HEADING.match(line):
+            match = MARKDOWN_HEADING.match(line)
+            block_tag = f"md_h{min(len(match.group(1)), 3)}"
+            self._inline(match.group(2), block_tag)
+        elif MARKDOWN_LIST_ITEM.match(line):
+            match = MARKDOWN_LIST_ITEM.match(line)
+            indent, marker, text = match.groups()
+            block_tag = "md_list"
+            self._add(indent + ("\u2022 " if marker in "-*+" else marker + " "), block_tag)
+            self._inline(text, block_tag)
+        elif MARKDOWN_QUOTE.match(line):
+            block_tag = "md_quote"
+            self._inline(MARKDOWN_QUOTE.match(line).group(1), block_tag)
+        else: self._inline(line, None)
+        self._add(end, block_tag)
+
+    def _inline(self, text, block_tag):
+        position = 0
+        for match in MARKDOWN_INLINE.finditer(text):
+            self._add(text[position:match.start()], block_tag)
+            code, bold, bold_alt, italic = match.groups()
+            if code is not None: self._add(code, block_tag, "md_code")
+            elif italic is not None: self._add(italic, block_tag, "md_italic")
+            else: self._add(bold if bold is not None else bold_alt, block_tag, "md_bold")
+            position = match.end()
+        self._add(text[position:], block_tag)
+
+    def _add(self, text, *tags):
+        if text: self.segments.append((text, (self.base_tag,) + tuple(tag for tag in tags if tag)))
+
+_markdown_cache = None
+
+def get_markdown_cache():
+    global _markdown_cache
+    if _markdown_cache is None:
+        _markdown_cache = LRUPool(MARKDOWN_CACHE_SIZE, MARKDOWN_CACHE_MB * 1024 * 1024,
+                                  lambda segments: sum(sys.getsizeof(text) for text, _ in segments))
+    return _markdown_cache
+
+def markdown_key(text):
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+def markdown_segments(text):
+    # Content-addressed, so a reloaded chat's fresh Message objects still hit the cache
+    key = markdown_key(text)
+    segments = get_markdown_cache().get(key)
+    if segments is None:
+        renderer = MarkdownStream()
+        segments = renderer.feed(text) + renderer.finish()
+        get_markdown_cache().put(key, segments)
+    return segments
+
+# --- Transcript View ---
+class TranscriptView:
+    # Keeps every message but only materializes a window of pages in the text widget;
+    # older/newer pages are swapped in as the user scrolls. Entries are the chat's own
+    # Message objects, or lists of (text, tag) segments for notices.
+    def __init__(self, textbox):
+        self.textbox = textbox
+        self.entries = []
+        self.open = None # Index of the reply still streaming in; its blank line comes when it ends
+        self.stream = None # MarkdownStream of the open reply
+        self.first = 0 # Window of materialized entries is [first, last)
+        self.last = 0
+        self.available_from = 0 # Entries before this are still being loaded (None)
+        self.page_pending = False
+        self.scrollbar_set = textbox._y_scrollbar.set
+        textbox._textbox.configure(yscrollcommand=self.on_scroll)
+
+    def clear(self):
+        self.load([])
+
+    def load(self, entries, total=None):
+        # With total, entries are the newest of total messages and fill() adds the older ones
+        entries = list(entries)
+        self.open = self.stream = None
+        self.available_from = 0 if total is None else total - len(entries)
+        self.entries = [None] * self.available_from + entries
+        self.show(len(self.entries))
+
+    def fill(self, start, entries):
+        self.entries[start:start + len(entries)] = entries
+        self.available_from = min(self.available_from, start)
+        if self.first > self.available_from and float(self.textbox.yview()[0]) <= 0.0 and not self.page_pending:
+            self.page_pending = True # Already scrolled to the top: show what just arrived
+            self.textbox.after_idle(self.page_older)
+
+    def append(self, entry, streaming=False):
+        self.close_last()
+        if self.last < len(self.entries): self.show(len(self.entries))
+        self.entries.append(entry)
+        if streaming:
+            self.open = len(self.entries) - 1
+            self.stream = MarkdownStream()
+        self.textbox.configure(state=tk.NORMAL)
+        self._insert_entry(len(self.entries) - 1, tk.END)
+        self.last = len(self.entries)
+        if self.last - self.first > TRANSCRIPT_PAGE_SIZE * TRANSCRIPT_MAX_PAGES:
+            self._release_oldest()
+        self.textbox.configure(state=tk.DISABLED)
+
+    def extend_last(self, text, tag=None):
+        if self.open is None:
+            self.append([(text, tag)])
+            return
+        if self.last < len(self.entries): self.show(len(self.entries))
+        self.entries[self.open].append(text)
+        self._replace_tail(self.stream.feed(text), self.stream.provisional())
+
+    def close_last(self):
+        if self.open is None: return
+        message, stream = self.entries[self.open], self.stream
+        self.open = self.stream = None
+        tail = stream.finish()
+        get_markdown_cache().put(markdown_key(message.text), stream.segments)
+        if self.last < len(self.entries): return # Not materialized; rendered whole when shown
+        self._replace_tail(tail + [("\n\n", None)], [])
+
+    def _replace_tail(self, final, provisional):
+        # Swaps the open reply's provisional last line for the lines completed since, then
+        # shows the new partial line; the "stream_tail" mark sits between the two
+        self.textbox.configure(state=tk.NORMAL)
+        self.textbox.delete("stream_tail", "end-1c")
+        self._insert_segments(final, tk.END)
+        self.textbox.mark_set("stream_tail", "end-1c")
+        self.textbox.mark_gravity("stream_tail", tk.LEFT)
+        self._insert_segments(provisional, tk.END)
+        self.textbox.configure(state=tk.DISABLED)
+
+    def show(self, index, highlight=False):
+        total = len(self.entries)
+        start = max(self.available_from, min(index - TRANSCRIPT_PAGE_SIZE // 2, total - TRANSCRIPT_PAGE_SIZE))
+        end = min(total, max(start + TRANSCRIPT_PAGE_SIZE, index + 1))
+        self.textbox.configure(state=tk.NORMAL)
+        for i in range(self.first, self.last): self.textbox.mark_unset(f"msg{i}")
+        self.textbox.delete("1.0", tk.END)
+        self.first = self.last = start
+        for i in range(start, end): self._insert_entry(i, tk.END)
+        self.last = end
+        self.textbox.configure(state=tk.DISABLED)
+        if index < end: self.textbox.yview(f"msg{index}")
+        else: self.textbox.see(tk.END)
+        if highlight and index < end:
+            self.textbox.tag_add("search_hit", f"msg{index}", f"msg{index + 1}" if index + 1 < end else tk.END)
+
+    def index_of(self, message, start=0):
+        # Entry showing one of the chat's messages. Notices and prompts of replies stopped before
+        # any text came in have entries but no turn, so it can come after the message's turn.
+        for i in range(start, len(self.entries)):
+            if self.entries[i] is message: return i
+        return None
+
+    def on_scroll(self, first, last):
+        self.scrollbar_set(first, last)
+        if self.page_pending: return
+        if float(first) <= 0.0 and self.first > self.available_from:
+            self.page_pending = True
+            self.textbox.after_idle(self.page_older)
+        elif float(last) >= 1.0 and self.last < len(self.entries):
+            self.page_pending = True
+            self.textbox.after_idle(self.page_newer)
+
+    def page_older(self):
+        self.page_pending = False
+        if self.first <= self.available_from: return
+        start = max(self.available_from, self.first - TRANSCRIPT_PAGE_SIZE)
+        anchor = f"msg{self.first}"
+        self.textbox.configure(state=tk.NORMAL)
+        self.textbox.mark_set("transcript_insert", "1.0")
+        self.textbox.mark_gravity("transcript_insert", tk.RIGHT)
+        for i in range(start, self.first): self._insert_entry(i, "transcript_insert")
+        self.textbox.mark_set(anchor, "transcript_insert") # Left gravity kept it at 1.0
+        self.textbox.mark_unset("transcript_insert")
+        self.first = start
+        if self.last - self.first > TRANSCRIPT_PAGE_SIZE * TRANSCRIPT_MAX_PAGES:
+            self._release_newest()
+        self.textbox.configure(state=tk.DISABLED)
+        self.textbox.yview(anchor)
+
+    def page_newer(self):
+        self.page_pending = False
+        if self.last >= len(self.entries): return
+        end = min(len(self.entries), self.last + TRANSCRIPT_PAGE_SIZE)
+        self.textbox.mark_set("transcript_view", "@0,0")
+        self.textbox.configure(state=tk.NORMAL)
+        for i in range(self.last, end): self._insert_entry(i, tk.END)
+        self.last = end
+        if self.last - self.first > TRANSCRIPT_PAGE_SIZE * TRANSCRIPT_MAX_PAGES:
+            self._release_oldest()
+        self.textbox.configure(state=tk.DISABLED)
+        self.textbox.yview("transcript_view")
+        self.textbox.mark_unset("transcript_view")
+
+    def _insert_entry(self, i, index):
+        mark = f"msg{i}"
+        self.textbox.mark_set(mark, index if index != tk.END else "end-1c")
+        self.textbox.mark_gravity(mark, tk.LEFT)
+        if i == self.open: # Always the last entry, so index is tk.END
+            self._insert_segments([("Gemini: ", "bot")] + self.stream.segments, index)
+            self.textbox.mark_set("stream_tail", "end-1c")
+            self.textbox.mark_gravity("stream_tail", tk.LEFT)
+            self._insert_segments(self.stream.provisional(), index)
+        else: self._insert_segments(self._segments(i), index)
+
+    def _insert_segments(self, segments, index):
+        for tag, group in itertools.groupby(segments, key=lambda segment: segment[1]):
+            self.textbox.insert(index, "".join(text for text, _ in group), tag)
+
+    def _segments(self, i):
+        entry = self.entries[i]
+        if not isinstance(entry, Message): return entry
+        if not entry.text: return [] # Empty turns keep a blank entry so indexes match turns
+        if entry.role != "model": return format_transcript_entry(entry.text, entry.role)
+        return [("Gemini: ", "bot")] + markdown_segments(entry.text) + [("\n\n", None)]
+
+    def _release_oldest(self):
+        cut = self.first + TRANSCRIPT_PAGE_SIZE
+        self.textbox.delete("1.0", f"msg{cut}")
+        for i in range(self.first, cut): self.textbox.mark_unset(f"msg{i}")
+        self.first = cut
+
+    def _release_newest(self):
+        cut = self.last - TRANSCRIPT_PAGE_SIZE
+        self.textbox.delete(f"msg{cut}", tk.END)
+        for i in range(cut, self.last): self.textbox.mark_unset(f"msg{i}")
+        self.last = cut
+
+# --- Chat Tabs ---
+class ChatTab:
+    # Everything that belongs to one open conversation. A tab owns no thread; while
+    # a reply streams, .request is its AsyncEngine job.
+    def __init__(self, name, textbox, context):
+        self.name = name
+        self.textbox = textbox
+        self.transcript = TranscriptView(textbox)
+        self.context = context
+        self.context_info = None # Last CONTEXT_UPDATE, shown again when the tab is selected
+        self.messages = MessageStore()
+        self.reply = None # Message the current request is streaming into
+        self.chat_file = None
+        self.dirty = False
+        self.saved_message_count = 0 # Messages already persisted to chat_file
+        self.autosave_job = None
+        self.request = None
+        self.loading = None # Executor job reading chat_file; its messages are ignored once superseded
+        self.show_when_loaded = None # Message index to reveal once loading finishes
+        self.metrics = None # RequestMetrics of the latest reply
+        self.status = "Ready."
+        self.closed = False # Set when the tab is closed; late messages for it are dropped
+
+    def is_empty(self):
+        return not self.chat_file and not self.dirty and not self.transcript.entries and self.request is None
+
+# --- Chat List View ---
+class ChatListView(ctk.CTkFrame):
+    # Sidebar history list backed by a small pool of recycled rows: only the rows
+    # in view exist as widgets, and a row is reconfigured only when its chat changes.
+    # Archived chats follow the live ones and are fetched a page at a time via
+    # on_more once the end of the list comes into view.
+    def __init__(self, master, font, on_load, on_delete, on_more=None, **kwargs):
+        super().__init__(master, fg_color="transparent", **kwargs)
+        self.font = font
+        self.on_load = on_load
+        self.on_delete = on_delete
+        self.on_more = on_more
+        self.items = []
+        self.members = set() # Same filenames as items, for membership checks at 50k chats
+        self.archived = set() # Items read from the archive, shown dimmed
+        self.has_more = on_more is not None
+        self.more_pending = False
+        self.offset = 0
+        self.visible = 1
+        self.rows = [] # (frame, load_button) pairs, reused for whichever chats are in view
+        self.bound = [] # (filename, archived) currently shown by each row
+        self.text_color = None # Theme color of live rows
+
+        self.grid_columnconfigure(0, weight=1)
+        self.grid_rowconfigure(1, weight=1)
+        ctk.CTkLabel(self, text="History").grid(row=0, column=0, columnspan=2, sticky="ew")
+        self.rows_frame = ctk.CTkFrame(self, fg_color="transparent", height=CHAT_LIST_ROW_HEIGHT)
+        self.rows_frame.grid(row=1, column=0, sticky="nsew")
+        self.rows_frame.grid_propagate(False)
+        self.rows_frame.grid_columnconfigure(0, weight=1)
+        self.scrollbar = ctk.CTkScrollbar(self, command=self.on_scrollbar)
+        self.scrollbar.grid(row=1, column=1, sticky="ns")
+        self.empty_label = ctk.CTkLabel(self.rows_frame, text="No saved chats", text_color="gray", font=font)
+        self.rows_frame.bind("<Configure>", self.on_resize)
+        self.bind_wheel(self.rows_frame)
+
+    def bind_wheel(self, widget):
+        for sequence in ("<MouseWheel>", "<Button-4>", "<Button-5>"):
+            widget.bind(sequence, self.on_wheel, add="+")
+
+    def create_row(self, i):
+        frame = ctk.CTkFrame(self.rows_frame, fg_color="transparent")
+        frame.grid(row=i, column=0, pady=(0, 2), sticky="ew")
+        frame.grid_columnconfigure(0, weight=1)
+        load_button = ctk.CTkButton(
+            frame, text="", font=self.font, anchor="w",
+            fg_color="transparent", hover_color=("#dbdbdb", "#2b2b2b"),
+            command=lambda i=i: self.activate(i, self.on_load)
+        )
+        load_button.grid(row=0, column=0, padx=(5,0), sticky="ew")
+        delete_button = ctk.CTkButton(
+            frame, text="X", font=self.font, width=20, height=20,
+            fg_color="transparent", hover_color="#AA0000", text_color=("#D2691E","#CD5C5C"),
+            command=lambda i=i: self.activate(i, self.on_delete)
+        )
+        delete_button.grid(row=0, column=1, padx=(0,5))
+        for widget in (frame, load_button, delete_button): self.bind_wheel(widget)
+        if self.text_color is None: self.text_color = load_button.cget("text_color")
+        frame.grid_remove()
+        self.rows.append((frame, load_button))
+        self.bound.append(None)
+
+    def activate(self, i, callback):
+        if self.bound[i]: callback(os.path.join(CHATS_DIR, self.bound[i][0]))
+
+    def set_items(self, items):
+        self.items = list(items)
+        self.members = set(self.items)
+        self.archived.clear()
+        self.has_more = self.on_more is not None
+        self.render()
+
+    def add_archived(self, filenames, has_more):
+        new = [filename for filename in filenames if filename not in self.members]
+        self.items.extend(new)
+        self.members.update(new)
+        self.archived.update(new)
+        self.has_more = has_more
+        self.render()
+
+    def insert(self, filename, index=0):
+        if filename in self.members: self.items.remove(filename)
+        self.archived.discard(filename) # Saved again, so it is live now
+        self.items.insert(index, filename)
+        self.members.add(filename)
+        self.render()
+
+    def remove(self, filename):
+        if filename in self.members:
+            self.items.remove(filename)
+            self.members.discard(filename)
+            self.archived.discard(filename)
+            self.render()
+
+    def scroll_to(self, offset):
+        offset = max(0, min(offset, len(self.items) - self.visible))
+        if offset != self.offset:
+            self.offset = offset
+            self.render()
+
+    def on_resize(self, event):
+        self.visible = max(1, event.height // CHAT_LIST_ROW_HEIGHT)
+        while len(self.rows) < self.visible: self.create_row(len(self.rows))
+        self.render()
+
+    def on_wheel(self, event):
+        up = getattr(event, "num", None) == 4 or getattr(event, "delta", 0) > 0
+        self.scroll_to(self.offset + (-1 if up else 1))
+
+    def on_scrollbar(self, action, value, unit="units"):
+        if action == "moveto":
+            self.scroll_to(int(float(value) * len(self.items)))
+        elif action == "scroll":
+            step = self.visible if unit == "pages" else 1
+            self.scroll_to(self.offset + (step if float(value) > 0 else -step))
+
+    def render(self):
+        self.offset = max(0, min(self.offset, len(self.items) - self.visible))
+        for i, (frame, load_button) in enumerate(self.rows):
+            index = self.offset + i
+            filename = self.items[index] if i < self.visible and index < len(self.items) else None
+            bound = (filename, filename in self.archived) if filename else None
+            if bound == self.bound[i]: continue # Row already shows this chat
+            self.bound[i] = bound
+            if filename is None:
+                frame.grid_remove()
+                continue
+            load_button.configure(text=os.path.splitext(filename)[0].replace('_', ' '),
+                                  text_color="gray" if bound[1] else self.text_color)
+            frame.grid()
+        if self.items: self.empty_label.grid_remove()
+        else: self.empty_label.grid(row=0, column=0, pady=5, sticky="ew")
+        total = len(self.items)
+        if total: self.scrollbar.set(self.offset / total, min(1.0, (self.offset + self.visible) / total))
+        else: self.scrollbar.set(0.0, 1.0)
+        if self.has_more and not self.more_pending and self.offset + self.visible >= total:
+            self.more_pending = True # End of the list is in view: fetch the next archived page
+            self.after_idle(self.load_more)
+
+    def load_more(self):
+        self.more_pending = False
+        self.on_more()
+
+# --- Model Backends ---
+# A backend turns a model name into an object with the SDK's GenerativeModel shape:
+# start_chat(history=...) returns a session with a settable .history,
+# send_message(prompt, stream=True, safety_settings=...) yielding chunks with .text,
+# and send_message_async(...) awaiting to a response that is iterated with async for.
+class GeminiBackend:
+    name = "gemini"
+
+    def configure(self, api_key):
+        import_genai().configure(api_key=api_key)
+
+    def create_model(self, model_name):
+        return import_genai().GenerativeModel(model_name)
+
+class MockBackend:
+    name = "mock"
+
+    def __init__(self, url):
+        self.url = url
+        self.api_key = ""
+
+    def configure(self, api_key):
+        self.api_key = api_key or ""
+
+    def create_model(self, model_name):
+        return MockModel(self, model_name)
+
+_embedded_mock_server = None
+
+def create_backend(config):
+    name = config.get(SETTINGS_SECTION, BACKEND_OPTION, fallback=DEFAULT_BACKEND)
+    if name != "mock": return GeminiBackend()
+    url = config.get(SETTINGS_SECTION, MOCK_URL_OPTION, fallback="").strip()
+    if not url:
+        global _embedded_mock_server
+        if _embedded_mock_server is None: _embedded_mock_server = MockServer(port=0, **mock_profile(config)).start()
+        url = _embedded_mock_server.url
+    return MockBackend(url)
+
+def mock_profile(config):
+    profile = dict(DEFAULT_MOCK_PROFILE)
+    for option, default in DEFAULT_MOCK_PROFILE.items():
+        try: profile[option] = type(default)(config.get(MOCK_SECTION, option, fallback=default))
+        except ValueError: pass
+    return profile
+
+class MockAPIError(Exception):
+    def __init__(self, status, message, retry_after=None):
+        super().__init__(f"{status} {message}")
+        self.status = status
+        self.retry_after = retry_after
+
+def mock_request(model, history, prompt, safety_settings):
+    url = urllib.parse.urlsplit(model.backend.url)
+    body = json.dumps({
+        "api_key": model.backend.api_key,
+        "contents": [{'role': message_role(msg), 'text': message_text(msg)} for msg in history],
+        "prompt": prompt,
+        "safety_settings": safety_settings or [],
+    }).encode("utf-8")
+    path = f"{url.path.rstrip('/')}/v1/models/{urllib.parse.quote(model.model_name)}:streamGenerateContent"
+    return url, path, body
+
+def mock_api_error(status, body, reason, retry_after):
+    try: error = json.loads(body or b"{}").get("error", {})
+    except ValueError: error = {}
+    return MockAPIError(status, error.get("message", reason), float(retry_after) if retry_after else None)
+
+def mock_stream_event(line):
+    event = json.loads(line)
+    if "error" in event: raise MockAPIError(event["error"].get("code", 500), event["error"].get("message", ""))
+    return event
+
+class MockChunk:
+    def __init__(self, text):
+        self.text = text
+        self.parts = [text]
+        self.prompt_feedback = None
+
+class MockModel:
+    def __init__(self, backend, model_name):
+        self.backend = backend
+        self.model_name = model_name
+
+    def start_chat(self, history=None):
+        return MockChatSession(self, history or [])
+
+class MockChatSession:
+    def __init__(self, model, history):
+        self.model = model
+        self.history = list(history)
+
+    def send_message(self, prompt, stream=True, safety_settings=None):
+        response = MockResponse(self.model, self.history, prompt, safety_settings)
+        response.on_finished = self.record_exchange(prompt)
+        return response
+
+    async def send_message_async(self, prompt, stream=True, safety_settings=None):
+        response = await MockAsyncResponse(self.model, self.history, prompt, safety_settings).connect()
+        response.on_finished = self.record_exchange(prompt)
+        return response
+
+    def record_exchange(self, prompt):
+        return lambda text: self.history.extend([
+            {'role': 'user', 'parts': [{'text': prompt}]},
+            {'role': 'model', 'parts': [{'text': text}]},
+        ])
+
+class MockResponse:
+    # One streaming request to the mock server; iterating yields MockChunks as
+    # newline-delimited JSON arrives.
+    def __init__(self, model, history, prompt, safety_settings):
+        self.on_finished = None
+        url, path, body = mock_request(model, history, prompt, safety_settings)
+        self.connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=60)
+        self.connection.request("POST", path, body=body, headers={"Content-Type": "application/json"})
+        self.response = self.connection.getresponse()
+        if self.response.status != 200:
+            body = self.response.read()
+            self.connection.close()
+            raise mock_api_error(self.response.status, body, self.response.reason, self.response.getheader("Retry-After"))
+
+    def __iter__(self):
+        parts = []
+        try:
+            for line in self.response:
+                if not line.strip(): continue
+                event = mock_stream_event(line)
+                if event.get("done"):
+                    if self.on_finished: self.on_finished("".join(parts))
+                    return
+                parts.append(event["text"])
+                yield MockChunk(event["text"])
+        finally:
+            self.connection.close()
+
+class MockAsyncResponse:
+    # asyncio counterpart of MockResponse for the AsyncEngine: waiting on the server
+    # holds no thread, and cancelling the task iterating it closes the connection.
+    def __init__(self, model, history, prompt, safety_settings):
+        self.on_finished = None
+        self.url, self.path, self.body = mock_request(model, history, prompt, safety_settings)
+        self.reader = self.writer = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.url.hostname, self.url.port or 80)
+        try:
+            self.writer.write((f"POST {self.path} HTTP/1.0\r\nHost: {self.url.netloc}\r\n"
+                               f"Content-Type: application/json\r\nContent-Length: {len(self.body)}\r\n\r\n").encode("latin-1") + self.body)
+            await self.writer.drain()
+            _, status, reason = (await self.reader.readline()).decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = (await self.reader.readline()).decode("latin-1").strip()
+                if not line: break
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            if int(status) != 200:
+                raise mock_api_error(int(status), await self.reader.read(), reason.strip(), headers.get("retry-after"))
+        except BaseException:
+            self.writer.close()
+            raise
+        return self
+
+    async def __aiter__(self):
+        parts = []
+        try:
+            async for line in self.reader:
+                if not line.strip(): continue
+                event = mock_stream_event(line)
+                if event.get("done"):
+                    if self.on_finished: self.on_finished("".join(parts))
+                    return
+                parts.append(event["text"])
+                yield MockChunk(event["text"])
+        finally:
+            self.writer.close()
+
+# --- Mock Server ---
+MOCK_WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor "
+              "incididunt ut labore et dolore magna aliqua").split()
+
+class MockRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.0" # Body ends when the connection closes, like a server-sent stream
+
+    def do_POST(self):
+        profile = self.server.profile
+        try: request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except ValueError: request = {}
+        if random.random() < profile["quota_rate"]:
+            self.send_error_json(429, "Quota exceeded for requests per minute.", {"Retry-After": str(profile["retry_after"])})
+            return
+        if random.random() < profile["error_rate"]:
+            self.send_error_json(500, "Internal error encountered.")
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        prompt = request.get("prompt", "")
+        words = [f"Mock reply to: {prompt[:60]}"] + [MOCK_WORDS[i % len(MOCK_WORDS)] for i in range(profile["response_tokens"])]
+        chunk_tokens = max(1, profile["chunk_tokens"])
+        interval = chunk_tokens / profile["tokens_per_sec"] if profile["tokens_per_sec"] > 0 else 0
+        try:
+            time.sleep(profile["ttft_ms"] / 1000)
+            for i in range(0, len(words), chunk_tokens):
+                if i: time.sleep(interval)
+                text = " ".join(words[i:i + chunk_tokens]) + " "
+                self.wfile.write(json.dumps({"text": text}).encode("utf-8") + b"\n")
+                self.wfile.flush()
+            self.wfile.write(b'{"done": true}\n')
+        except (BrokenPipeError, ConnectionResetError): pass # Client cancelled the stream
+
+    def send_error_json(self, status, message, headers=None):
+        body = json.dumps({"error": {"code": status, "message": message}}).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items(): self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): pass
+
+class MockServer:
+    # Local stand-in for the Gemini streaming endpoint with configurable latency,
+    # token rate, chunking, errors and quota responses, for offline load testing.
+    def __init__(self, host="127.0.0.1", port=DEFAULT_MOCK_PORT, **profile):
+        self.httpd = http.server.ThreadingHTTPServer((host, port), MockRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.profile = dict(DEFAULT_MOCK_PROFILE, **profile)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+# --- Context Window ---
+def estimate_tokens(text):
+    return max(1, (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN)
+
+def context_budget_for(model_name, config):
+    budget = config.getint(SETTINGS_SECTION, CONTEXT_BUDGET_OPTION, fallback=DEFAULT_CONTEXT_TOKEN_BUDGET)
+    limit = MODEL_CONTEXT_LIMITS.get(model_name)
+    return min(budget, limit - RESPONSE_TOKEN_RESERVE) if limit else budget
+
+class ContextWindow:
+    # Picks the part of a chat's history sent with each request. The newest whole
+    # exchanges that fit the token budget are kept and older user turns are folded
+    # into a short extractive summary. Token estimates are cached per message.
+    def __init__(self, budget):
+        self.budget = budget
+        self.token_counts = [] # Aligned with the (append-only) history list
+
+    def reset(self):
+        self.token_counts = []
+
+    def counts(self, history):
+        if len(self.token_counts) > len(history): self.token_counts = []
+        for msg in history[len(self.token_counts):]:
+            self.token_counts.append(estimate_tokens(message_text(msg)))
+        return self.token_counts
+
+    def select(self, history, prompt):
+        counts = self.counts(history)
+        prompt_tokens = estimate_tokens(prompt)
+        total = prompt_tokens + sum(counts)
+        if total <= self.budget: return list(history), total
+        summary_budget = self.budget // 10
+        available = self.budget - prompt_tokens - summary_budget
+        start = end = len(history)
+        kept = 0
+        while end > 0:
+            begin = end - 1
+            while begin > 0 and message_role(history[begin]) != 'user': begin -= 1 # Keep exchanges whole
+            cost = sum(counts[begin:end])
+            if kept + cost > available: break
+            kept += cost
+            start = end = begin
+        context = list(history[start:])
+        summary = self.summarize(history[:start], summary_budget)
+        if summary:
+            context[:0] = [{'role': 'user', 'parts': [{'text': summary}]}, {'role': 'model', 'parts': [{'text': "Understood."}]}]
+            kept += estimate_tokens(summary)
+        return context, prompt_tokens + kept
+
+    def summarize(self, dropped, budget):
+        lines = []
+        used = 0
+        for msg in reversed(dropped):
+            if message_role(msg) != 'user': continue
+            text = " ".join(message_text(msg).split())
+            line = "- " + (text.split(". ")[0][:160] if text else "")
+            if used + estimate_tokens(line) > budget: break
+            used += estimate_tokens(line)
+            lines.append(line)
+        if not lines: return ""
+        return ("Earlier turns of this conversation were omitted to fit the context window. "
+                "The user had asked about:\n" + "\n".join(reversed(lines)))
+
+# --- Retrieval Index ---
+RETRIEVAL_WORD = re.compile(r"\w\w+")
+
+def hashed_features(text):
+    # Feature hashing of words and word pairs: slot -> signed, log-scaled term frequency
+    words = RETRIEVAL_WORD.findall(text.lower())
+    slots = {}
+    for feature, count in collections.Counter(words + [f"{a} {b}" for a, b in zip(words, words[1:])]).items():
+        h = zlib.crc32(feature.encode("utf-8"))
+        weight = 1.0 + math.log(count)
+        slot = h % RETRIEVAL_DIMENSIONS
+        slots[slot] = slots.get(slot, 0.0) + (weight if h & 0x80000000 else -weight)
+    return slots
+
+def split_snippets(text, size=RETRIEVAL_SNIPPET_CHARS):
+    # (start, end) spans of about size characters, broken at whitespace where possible
+    spans = []
+    start = 0
+    while start < len(text):
+        end = min(len(text), start + size)
+        if end < len(text):
+            space = max(text.rfind(" ", start + size // 2, end), text.rfind("\n", start + size // 2, end))
+            if space > start: end = space
+        if text[start:end].strip(): spans.append((start, end))
+        start = end
+    return spans
+
+class RetrievalIndex:
+    # Hashed TF-IDF vectors for every snippet of every message in the catalog, so earlier
+    # chats can be searched for a prompt offline. Vectors are stored sparse, as (slot, row,
+    # value) postings appended to flat files as new catalog messages appear; a search scores
+    # only the rows in the posting lists of the query's slots, from a slot-ordered copy kept
+    # in memory. Rows are read through a memory map and point at catalog message ids; rows
+    # whose message has since been rewritten or deleted are skipped by search and dropped
+    # when more than half the index is stale.
+    VERSION = 3
+    ROW_DTYPE = [("id", "<i8"), ("start", "<i4"), ("end", "<i4")]
+    POSTING_DTYPE = [("slot", "<u2"), ("row", "<i4"), ("value", "<f2")]
+
+    def __init__(self, np, catalog, directory=RETRIEVAL_DIR):
+        self.np = np
+        self.catalog = catalog
+        self.directory = directory
+        self.rows_path = os.path.join(directory, "rows.bin")
+        self.postings_path = os.path.join(directory, "postings.bin")
+        self.df_path = os.path.join(directory, "df.npy")
+        self.state_path = os.path.join(directory, "state.json")
+        self.lock = threading.Lock()
+        self.mapped = None # (rows, rows memmap)
+        self.postings = None # (postings merged, rows by slot, values by slot, slot offsets)
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        np = self.np
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f: self.state = json.load(f)
+            if self.state.get("version") != self.VERSION or self.state.get("dimensions") != RETRIEVAL_DIMENSIONS: raise ValueError
+            self.df = np.load(self.df_path)
+            for path, count, row_bytes in ((self.rows_path, self.state["rows"], np.dtype(self.ROW_DTYPE).itemsize),
+                                           (self.postings_path, self.state["postings"], np.dtype(self.POSTING_DTYPE).itemsize)):
+                if os.path.getsize(path) < count * row_bytes: raise ValueError # Lost appends; start over
+                with open(path, 'r+b') as f: f.truncate(count * row_bytes) # Appends after the last saved state
+        except (OSError, ValueError, KeyError):
+            self._reset()
+
+    def _reset(self):
+        self.state = {"version": self.VERSION, "dimensions": RETRIEVAL_DIMENSIONS, "rows": 0, "postings": 0, "messages": 0, "last_id": 0}
+        self.df = self.np.zeros(RETRIEVAL_DIMENSIONS, self.np.int64)
+        self.mapped = self.postings = None
+        for path in (self.rows_path, self.postings_path): open(path, 'wb').close()
+        try: os.remove(os.path.join(self.directory, "vectors.f16")) # Dense vectors of earlier versions
+        except FileNotFoundError: pass
+        self._save_state()
+
+    def _save_state(self):
+        with open(self.df_path + ".tmp", 'wb') as f: self.np.save(f, self.df)
+        os.replace(self.df_path + ".tmp", self.df_path)
+        with open(self.state_path + ".tmp", 'w', encoding='utf-8') as f: json.dump(self.state, f)
+        os.replace(self.state_path + ".tmp", self.state_path) # Written last: it decides how many rows count
+
+    def _vector(self, slots, idf=None):
+        np = self.np
+        vector = np.zeros(RETRIEVAL_DIMENSIONS, np.float32)
+        if not slots: return vector
+        indexes = np.fromiter(slots.keys(), np.int64, len(slots))
+        vector[indexes] = np.fromiter(slots.values(), np.float32, len(slots))
+        if idf is not None: vector *= idf
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def update(self):
+        # Embeds the catalog messages added since the last update; returns how many
+        with self.lock:
+            added = self._embed_new()
+            live = self.catalog.count_messages()
+            if self.state["messages"] - live > live: # Mostly rewritten or deleted chats; rebuild
+                self._reset()
+                added = self._embed_new()
+            return added
+
+    def _embed_new(self):
+        np = self.np
+        added = 0
+        while True:
+            batch = self.catalog.messages_after(self.state["last_id"], RETRIEVAL_BATCH_SIZE)
+            if not batch: return added
+            rows, postings = [], []
+            for message_id, content in batch:
+                for start, end in split_snippets(content):
+                    slots = hashed_features(content[start:end])
+                    if not slots: continue
+                    row = self.state["rows"] + len(rows)
+                    vector = self._vector(slots)
+                    rows.append((message_id, start, end))
+                    postings.extend((slot, row, vector[slot]) for slot in slots)
+                    self.df[list(slots)] += 1
+            if rows:
+                with open(self.rows_path, 'ab') as f: f.write(np.array(rows, self.ROW_DTYPE).tobytes())
+                with open(self.postings_path, 'ab') as f: f.write(np.array(postings, self.POSTING_DTYPE).tobytes())
+            self.state["rows"] += len(rows)
+            self.state["postings"] += len(postings)
+            self.state["messages"] += len(batch)
+            self.state["last_id"] = batch[-1][0]
+            self._save_state()
+            added += len(batch)
+
+    def _map(self):
+        rows = self.state["rows"]
+        if self.mapped is None or self.mapped[0] != rows:
+            np = self.np
+            self.mapped = (rows, np.memmap(self.rows_path, np.dtype(self.ROW_DTYPE), "r", shape=(rows,)))
+        return self.mapped[1]
+
+    def _posting_lists(self):
+        # Rows using each slot, ascending, and their values there: rows_by_slot[offsets[slot]:offsets[slot + 1]].
+        # Only postings appended since the last search are read, sorted and merged in.
+        np = self.np
+        if self.postings is None:
+            self.postings = (0, np.zeros(0, np.int32), np.zeros(0, np.float16), np.zeros(RETRIEVAL_DIMENSIONS + 1, np.int64))
+        merged, rows_by_slot, values_by_slot, offsets = self.postings
+        count = self.state["postings"]
+        if merged < count:
+            dtype = np.dtype(self.POSTING_DTYPE)
+            new = np.fromfile(self.postings_path, dtype, count - merged, offset=merged * dtype.itemsize)
+            new = new[np.argsort(new["slot"], kind="stable")] # Appended in row order, so rows stay ascending
+            at = offsets[new["slot"].astype(np.int64) + 1] # Each after the slot's existing postings
+            rows_by_slot = np.insert(rows_by_slot, at, new["row"])
+            values_by_slot = np.insert(values_by_slot, at, new["value"])
+            offsets = offsets + np.concatenate(([0], np.cumsum(np.bincount(new["slot"], minlength=RETRIEVAL_DIMENSIONS))))
+            self.postings = (count, rows_by_slot, values_by_slot, offsets)
+        return rows_by_slot, values_by_slot, offsets
+
+    def search(self, query, exclude=(), limit=RETRIEVAL_TOP_K, token_budget=DEFAULT_RETRIEVAL_TOKEN_BUDGET):
+        # Best snippets for query outside the chats in exclude, within token_budget
+        np = self.np
+        with self.lock:
+            total = self.state["rows"]
+            slots = hashed_features(query)
+            if not total or not slots: return []
+            idf = np.log((total + 1) / (self.df + 1)).astype(np.float32) + 1
+            query_vector = self._vector(slots, idf)
+            columns = np.flatnonzero(query_vector)
+            weights = query_vector[columns]
+            rows = self._map()
+            rows_by_slot, values_by_slot, offsets = self._posting_lists()
+            # Rows without any of the query's slots score 0, so only the query slots' postings are read
+            spans = [slice(offsets[slot], offsets[slot + 1]) for slot in columns]
+            posted = np.concatenate([rows_by_slot[span] for span in spans])
+            products = np.concatenate([values_by_slot[span].astype(np.float32) * weight for span, weight in zip(spans, weights)])
+            scores = np.bincount(posted, products, total)
+            matched = np.flatnonzero(scores >= RETRIEVAL_MIN_SCORE)
+            if not len(matched): return []
+            scores = scores[matched]
+            candidates = min(len(matched), limit * 8) # Room for stale, excluded and repeated messages
+            best = np.argpartition(-scores, candidates - 1)[:candidates]
+            best = [int(i) for i in best[np.argsort(-scores[best])] if scores[i] >= RETRIEVAL_MIN_SCORE]
+            hits = [(int(rows[matched[i]]["id"]), int(rows[matched[i]]["start"]), int(rows[matched[i]]["end"]), float(scores[i]))
+                    for i in best]
+        messages = self.catalog.get_messages({message_id for message_id, _, _, _ in hits})
+        results, seen, used = [], set(), 0
+        for message_id, start, end, score in hits:
+            message = messages.get(message_id)
+            if message is None or message["filename"] in exclude or message_id in seen: continue
+            text = " ".join(message["content"][start:end].split())
+            tokens = estimate_tokens(text)
+            if used + tokens > token_budget: continue
+            seen.add(message_id)
+            used += tokens
+            results.append({"filename": message["filename"], "title": message["title"], "turn": message["turn"],
+                            "role": message["role"], "text": text, "score": score})
+            if len(results) == limit: break
+        return results
+
+_retrieval_index = None
+
+def get_retrieval_index():
+    # None when NumPy or the catalog's message index is unavailable
+    global _retrieval_index
+    if _retrieval_index is None:
+        np = import_numpy()
+        catalog = get_catalog()
+        if np is None or catalog is None or not catalog.search_enabled: return None
+        try: _retrieval_index = RetrievalIndex(np, catalog)
+        except OSError: return None
+    return _retrieval_index
+
+def retrieve_snippets(query, exclude=(), token_budget=DEFAULT_RETRIEVAL_TOKEN_BUDGET):
+    # Catches the index up with the catalog, then searches it. Returns (snippets, seconds),
+    # or (None, 0) when retrieval is unavailable.
+    started = time.perf_counter()
+    index = get_retrieval_index()
+    if index is None: return None, 0.0
+    try:
+        index.update()
+        snippets = index.search(query, exclude, token_budget=token_budget)
+    except (OSError, ValueError, sqlite3.Error):
+        snippets = []
+    return snippets, time.perf_counter() - started
+
+def attach_snippets(prompt, snippets):
+    lines = [f"[{snippet['title']}, {'user' if snippet['role'] == 'user' else 'assistant'}]: {snippet['text']}" for snippet in snippets]
+    return ("Excerpts from the user's earlier chats that may be relevant (they may be outdated; ignore any that are not):\n"
+            + "\n".join(lines) + "\n\n---\n\n" + prompt)
+
+# --- Response Cache ---
+class ResponseCache:
+    # Opt-in, content-addressed store of streamed replies, one file per entry and
+    # bounded by total size with LRU eviction (file mtime is the recency stamp).
+    def __init__(self, directory=CACHE_DIR, max_bytes=DEFAULT_RESPONSE_CACHE_MB * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict() # key -> size, least recently used first
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        with os.scandir(directory) as scan:
+            found = [(entry.stat().st_mtime, entry.name[:-5], entry.stat().st_size) for entry in scan if entry.name.endswith('.json')]
+        for _, key, size in sorted(found):
+            self.entries[key] = size
+            self.total_bytes += size
+        self._evict()
+
+    @staticmethod
+    def key(model_name, history, prompt, safety_settings):
+        digest = hashlib.sha256()
+        for msg in history:
+            digest.update(json.dumps([message_role(msg), message_text(msg)]).encode('utf-8'))
+        history_hash = digest.hexdigest()
+        material = json.dumps([model_name, history_hash, prompt, safety_settings], sort_keys=True)
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            path = os.path.join(self.directory, key + '.json')
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    chunks = json.load(f)['chunks']
+                os.utime(path)
+            except (OSError, ValueError, KeyError):
+                self.total_bytes -= self.entries.pop(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return chunks
+
+    def put(self, key, chunks):
+        path = os.path.join(self.directory, key + '.json')
+        data = json.dumps({'chunks': chunks}, ensure_ascii=False).encode('utf-8')
+        with self.lock:
+            try:
+                with open(path + '.tmp', 'wb') as f: f.write(data)
+                os.replace(path + '.tmp', path)
+            except OSError: return
+            self.total_bytes += len(data) - self.entries.pop(key, 0)
+            self.entries[key] = len(data)
+            self._evict()
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries), 'bytes': self.total_bytes}
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            try: os.remove(os.path.join(self.directory, key + '.json'))
+            except OSError: pass
+
+# --- Session Pool ---
+class LRUPool:
+    # Recently used live objects by key. Past max_items entries, or max_bytes as
+    # estimated by sizeof(value), the least recently used are dropped.
+    def __init__(self, max_items, max_bytes=None, sizeof=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.entries = collections.OrderedDict() # key -> (value, size), oldest first
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None: return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value):
+        size = self.sizeof(value) if self.sizeof else 0
+        with self.lock:
+            self._remove(key)
+            self.entries[key] = (value, size)
+            self.total_bytes += size
+            self._evict()
+
+    def resize(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def pop(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            self._remove(key)
+            return entry[0] if entry else None
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry: self.total_bytes -= entry[1]
+
+    def _evict(self):
+        while self.entries and (len(self.entries) > self.max_items or
+                                (self.max_bytes is not None and self.total_bytes > self.max_bytes)):
+            self._remove(next(iter(self.entries)))
+
+def pooled_chat_size(pooled):
+    # Transcript entries share the store's Message objects; only notices add to it
+    messages, entries = pooled
+    return (messages.nbytes + sys.getsizeof(entries) +
+            sum(sys.getsizeof(text) for segments in entries if isinstance(segments, list) for text, _ in segments))
+
+# --- Rate Limiter ---
+def is_quota_error(error):
+    return (getattr(error, "status", None) == 429 or getattr(error, "code", None) == 429 or
+            type(error).__name__ in ("ResourceExhausted", "TooManyRequests") or "Quota" in str(error))
+
+def retry_after_hint(error):
+    # Seconds the server asked us to wait: MockAPIError carries Retry-After, the Gemini
+    # API puts it in the message ("Please retry in 21.5s")
+    if getattr(error, "retry_after", None): return float(error.retry_after)
+    match = re.search(r"retry in ([\d.]+)\s*s", str(error))
+    return float(match.group(1)) if match else None
+
+def retry_delay(error, attempt):
+    backoff = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+    delay = backoff / 2 + random.uniform(0, backoff / 2) # Jitter keeps tabs from retrying in lockstep
+    hint = retry_after_hint(error)
+    return max(delay, hint + random.uniform(0, RETRY_BASE_DELAY)) if hint else delay
+
+class TokenBucket:
+    def __init__(self, requests_per_minute, burst):
+        self.max_rate = requests_per_minute / 60
+        self.rate = self.max_rate # Requests per second currently allowed
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.waiting = 0
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def throttle(self, delay):
+        self.refill()
+        self.rate = max(self.max_rate * MIN_RATE_FRACTION, self.rate / 2)
+        self.tokens = min(self.tokens, 1 - delay * self.rate) # Next token comes due when the retry does
+
+    def recover(self):
+        self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+class RateLimiter:
+    # Client-side token buckets per (model, API key), used from the AsyncEngine loop.
+    # Requests wait for a token instead of hitting the quota; a quota error halves the
+    # bucket's rate and is retried with jittered exponential backoff, honoring the
+    # server's retry-after hint, and each success raises the rate back gradually.
+    def __init__(self, requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE, burst=REQUEST_BURST, on_change=None):
+        self.requests_per_minute = max(1, requests_per_minute)
+        self.burst = burst
+        self.on_change = on_change or (lambda: None)
+        self.buckets = {}
+
+    def bucket(self, key):
+        if key not in self.buckets: self.buckets[key] = TokenBucket(self.requests_per_minute, self.burst)
+        return self.buckets[key]
+
+    def queue_depth(self):
+        return sum(bucket.waiting for bucket in list(self.buckets.values()))
+
+    def rate_per_minute(self, key):
+        bucket = self.buckets.get(key)
+        return (bucket.rate if bucket else self.requests_per_minute / 60) * 60
+
+    async def acquire(self, bucket, on_wait):
+        bucket.refill()
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            return
+        bucket.waiting += 1
+        self.on_change()
+        on_wait(f"Waiting {(1 - bucket.tokens) / bucket.rate:.1f}s for the rate limit...")
+        try:
+            while True: # Rechecked after each sleep, since a quota error may have slowed the bucket
+                await asyncio.sleep((1 - bucket.tokens) / bucket.rate)
+                bucket.refill()
+                if bucket.tokens >= 1:
+                    bucket.tokens -= 1
+                    return
+        finally:
+            bucket.waiting -= 1
+            self.on_change()
+
+    async def call(self, key, send, on_wait):
+        bucket = self.bucket(key)
+        for attempt in itertools.count():
+            await self.acquire(bucket, on_wait)
+            try: result = await send()
+            except Exception as e:
+                if not is_quota_error(e) or attempt >= MAX_QUOTA_RETRIES: raise
+                delay = retry_delay(e, attempt)
+                bucket.throttle(delay)
+                self.on_change()
+                on_wait(f"Quota reached, retrying in {delay:.1f}s ({attempt + 1}/{MAX_QUOTA_RETRIES})...")
+                await asyncio.sleep(delay)
+                continue
+            if bucket.rate < bucket.max_rate:
+                bucket.recover()
+                self.on_change()
+            return result
+
+# --- Metrics ---
+class RequestMetrics:
+    # perf_counter timestamps of one reply, from the Send click to its last rendered chunk
+    def __init__(self, model_name):
+        self.model_name = model_name
+        self.submitted = time.perf_counter()
+        self.started = None # Engine slot acquired
+        self.sent = None # Last attempt of the send call, after rate limiting
+        self.first_chunk = None
+        self.stream_end = None
+        self.first_render = None
+        self.rendered = None
+        self.chunk_times = []
+        self.chunks = 0
+        self.chars = 0
+        self.retries = 0
+        self.cached = False
+        self.outcome = None
+        self.retrieval_ms = None
+
+    def on_send(self):
+        if self.sent is not None: self.retries += 1
+        self.sent = time.perf_counter()
+
+    def on_chunk(self, text):
+        now = time.perf_counter()
+        if self.first_chunk is None: self.first_chunk = now
+        self.chunk_times.append(now)
+        self.chunks += 1
+        self.chars += len(text)
+
+    def on_render(self):
+        self.rendered = time.perf_counter()
+        if self.first_render is None: self.first_render = self.rendered
+
+    def ttft(self):
+        return self.first_chunk - self.sent if self.first_chunk and self.sent else None
+
+    def tokens_per_second(self):
+        if self.chunks < 2: return None # One chunk says nothing about the streaming rate
+        elapsed = (self.stream_end or time.perf_counter()) - self.first_chunk
+        return self.chars / CHARS_PER_TOKEN / elapsed if elapsed > 0 else None
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # Last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        return list(itertools.accumulate(self.counts))
+
+class MetricsRegistry:
+    # Histograms and counters keyed by name and labels, filled on the Tk thread and
+    # exported as JSON or Prometheus text exposition format.
+    def __init__(self):
+        self.histograms = {} # (name, labels) -> Histogram
+        self.counters = collections.Counter() # (name, labels) -> value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS_MS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None: histogram = self.histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    def count(self, name, amount=1, **labels):
+        self.counters[(name, tuple(sorted(labels.items())))] += amount
+
+    def record(self, metrics):
+        model = metrics.model_name
+        self.count("requests_total", model=model, outcome=metrics.outcome)
+        self.count("chunks_total", metrics.chunks, model=model)
+        self.count("chars_total", metrics.chars, model=model)
+        self.count("retries_total", metrics.retries, model=model)
+        if metrics.started: self.observe("queue_wait_ms", (metrics.started - metrics.submitted) * 1000, model=model)
+        if metrics.rendered: self.observe("total_ms", (metrics.rendered - metrics.submitted) * 1000, model=model)
+        if metrics.retrieval_ms is not None: self.observe("retrieval_ms", metrics.retrieval_ms, model=model)
+        if metrics.cached:
+            self.count("cached_replies_total", model=model)
+            return # Replayed from disk; network timings would only skew the histograms
+        if metrics.ttft() is not None: self.observe("ttft_ms", metrics.ttft() * 1000, model=model)
+        for previous, current in zip(metrics.chunk_times, metrics.chunk_times[1:]):
+            self.observe("chunk_gap_ms", (current - previous) * 1000, model=model)
+        if metrics.first_chunk and metrics.stream_end:
+            self.observe("stream_ms", (metrics.stream_end - metrics.first_chunk) * 1000, model=model)
+        if metrics.stream_end and metrics.rendered:
+            self.observe("render_lag_ms", max(0.0, metrics.rendered - metrics.stream_end) * 1000, model=model)
+        if metrics.tokens_per_second() is not None:
+            self.observe("tokens_per_second", metrics.tokens_per_second(), TOKEN_RATE_BUCKETS, model=model)
+
+    def to_json(self):
+        histograms = collections.defaultdict(list)
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            histograms[name].append({"labels": dict(labels), "buckets": list(histogram.buckets),
+                                     "counts": histogram.counts, "sum": histogram.sum, "count": histogram.count})
+        counters = collections.defaultdict(list)
+        for (name, labels), value in sorted(self.counters.items()):
+            counters[name].append({"labels": dict(labels), "value": value})
+        return {"generated": datetime.datetime.now().isoformat(timespec="seconds"),
+                "histograms": histograms, "counters": counters}
+
+    def to_prometheus(self):
+        def label_text(labels, extra=()):
+            pairs = [f'{name}="{str(value)}"' for name, value in list(labels) + list(extra)]
+            return "{" + ",".join(pairs) + "}" if pairs else ""
+        lines = []
+        for name in sorted({name for name, _ in self.counters}):
+            lines.append(f"# TYPE {METRICS_PREFIX}{name} counter")
+            for (counter_name, labels), value in sorted(self.counters.items()):
+                if counter_name == name: lines.append(f"{METRICS_PREFIX}{name}{label_text(labels)} {value}")
+        for name in sorted({name for name, _ in self.histograms}):
+            lines.append(f"# TYPE {METRICS_PREFIX}{name} histogram")
+            for (histogram_name, labels), histogram in sorted(self.histograms.items()):
+                if histogram_name != name: continue
+                bounds = [str(bound) for bound in histogram.buckets] + ["+Inf"]
+                for bound, count in zip(bounds, histogram.cumulative()):
+                    lines.append(f"{METRICS_PREFIX}{name}_bucket{label_text(labels, [('le', bound)])} {count}")
+                lines.append(f"{METRICS_PREFIX}{name}_sum{label_text(labels)} {histogram.sum:.3f}")
+                lines.append(f"{METRICS_PREFIX}{name}_count{label_text(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, path):
+        text = json.dumps(self.to_json(), indent=2) if path.endswith(".json") else self.to_prometheus()
+        temp_path = path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f: f.write(text)
+        os.replace(temp_path, path) # Scrapers never see a half-written file
+
+# --- Stall Watchdog ---
+def sample_stack(frame):
+    # Innermost first, as (filename, function first line, function name, line)
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append((code.co_filename, code.co_firstlineno, code.co_name, frame.f_lineno))
+        frame = frame.f_back
+    return tuple(stack)
+
+def format_frame(filename, name, lineno):
+    return f"{name} ({os.path.basename(filename)}:{lineno})"
+
+class StallWatchdog:
+    # A Tk timer beats every STALL_HEARTBEAT_MS; how late it fires is the event-loop lag.
+    # A helper thread watches the beat, and once it is late by more than the threshold,
+    # samples the main thread's stack until the loop comes back. Each stall is written to
+    # STALL_LOG_FILE with its duration and hottest frames.
+    def __init__(self, root, threshold_ms, metrics, log_path=STALL_LOG_FILE):
+        self.root = root
+        self.threshold = threshold_ms / 1000
+        self.metrics = metrics
+        self.log_path = log_path
+        self.main_thread_id = threading.get_ident() # Created on the Tk thread
+        self.last_beat = time.perf_counter()
+        self.stopped = threading.Event()
+        self.logger = None
+        self.thread = threading.Thread(target=self.watch, daemon=True)
+
+    def start(self):
+        self.last_beat = time.perf_counter()
+        self.root.after(STALL_HEARTBEAT_MS, self.beat)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def beat(self):
+        if self.stopped.is_set(): return
+        now = time.perf_counter()
+        lag = max(0.0, now - self.last_beat - STALL_HEARTBEAT_MS / 1000)
+        self.last_beat = now
+        self.metrics.observe("loop_lag_ms", lag * 1000)
+        if lag > self.threshold: self.metrics.count("stalls_total")
+        self.root.after(STALL_HEARTBEAT_MS, self.beat)
+
+    def watch(self):
+        interval = STALL_SAMPLE_INTERVAL_MS / 1000
+        while True:
+            # Idle until the latest beat would count as a stall; only sampling runs at the fast interval
+            beat = self.last_beat
+            remaining = beat + STALL_HEARTBEAT_MS / 1000 + self.threshold - time.perf_counter()
+            if remaining > 0:
+                if self.stopped.wait(remaining): return
+                continue
+            if self.stopped.is_set(): return
+            samples = collections.Counter() # Stack -> times seen
+            while self.last_beat == beat and not self.stopped.is_set():
+                frame = sys._current_frames().get(self.main_thread_id)
+                if frame is not None: samples[sample_stack(frame)] += 1
+                frame = None # Don't keep the main thread's frames alive between samples
+                time.sleep(interval)
+            end = self.last_beat if self.last_beat != beat else time.perf_counter()
+            self.report(end - beat - STALL_HEARTBEAT_MS / 1000, samples)
+
+    def report(self, duration, samples):
+        total = sum(samples.values())
+        lines = [f"Stall of {duration * 1000:.0f} ms ({total} samples)"]
+        if total:
+            # Where the time went: the innermost frame of each sample, and the innermost
+            # frame of this app's own code, which names the handler that blocked the loop
+            leaves, handlers = collections.Counter(), collections.Counter()
+            for stack, count in samples.items():
+                filename, _, name, lineno = stack[0]
+                leaves[(filename, name, lineno)] += count
+                own = next((frame for frame in stack if frame[0] == __file__), None)
+                if own: handlers[(own[0], own[2], own[1])] += count
+            for title, frames in (("Hot frames", leaves), ("Blocking functions", handlers)):
+                if not frames: continue
+                lines.append(f"  {title}:")
+                lines.extend(f"    {count / total:6.1%}  {format_frame(*frame)}" for frame, count in frames.most_common(STALL_TOP_FRAMES))
+            stack, count = samples.most_common(1)[0]
+            lines.append(f"  Most common stack ({count / total:.0%} of samples), outermost first:")
+            lines.extend(f"    {format_frame(filename, name, lineno)}" for filename, _, name, lineno in reversed(stack))
+        self.log("\n".join(lines))
+
+    def log(self, text):
+        if self.logger is None:
+            try: ensure_config_dir()
+            except OSError: return
+            handler = logging.handlers.RotatingFileHandler(self.log_path, maxBytes=STALL_LOG_MAX_BYTES,
+                                                           backupCount=STALL_LOG_BACKUPS, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+            self.logger = logging.getLogger(f"{__name__}.stalls")
+            self.logger.propagate = False
+            self.logger.setLevel(logging.INFO)
+            self.logger.addHandler(handler)
+        self.logger.info(text)
+
+# --- Request Executor ---
+class Job:
+    PENDING, RUNNING, DONE, FAILED, CANCELLED = "pending", "running", "done", "failed", "cancelled"
+
+    def __init__(self, func, args, priority, on_complete):
+        self.func = func
+        self.args = args
+        self.priority = priority
+        self.on_complete = on_complete
+        self.status = Job.PENDING
+        self.result = None
+        self.error = None
+        self.cancel_event = threading.Event()
+        self.task = None # asyncio task while an AsyncEngine job runs
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+class RequestExecutor:
+    # The one worker thread that talks to the API. It owns the model/chat objects,
+    # runs jobs by priority then submission order, and reports completion via
+    # post_message so callbacks run on the Tk thread.
+    def __init__(self, post_message, max_pending=REQUEST_QUEUE_LIMIT):
+        self.post_message = post_message
+        self.max_pending = max_pending
+        self.queue = queue.PriorityQueue()
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+        self.pending = [] # Jobs queued but not started, for cancellation and back-pressure
+        self.current_job = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, func, *args, priority=JOB_PRIORITY_NORMAL, on_complete=None):
+        job = Job(func, args, priority, on_complete)
+        with self.lock:
+            if priority != JOB_PRIORITY_HIGH and sum(1 for j in self.pending if j.priority != JOB_PRIORITY_HIGH) >= self.max_pending:
+                raise queue.Full
+            self.pending.append(job)
+        self.queue.put((priority, next(self.sequence), job))
+        return job
+
+    def cancel_pending(self, priority=JOB_PRIORITY_NORMAL):
+        with self.lock:
+            for job in self.pending:
+                if job.priority == priority: job.cancel()
+
+    def queue_depth(self):
+        with self.lock:
+            return len(self.pending)
+
+    def run(self):
+        while True:
+            _, _, job = self.queue.get()
+            with self.lock:
+                self.pending.remove(job)
+            if job.cancelled:
+                job.status = Job.CANCELLED
+            else:
+                job.status = Job.RUNNING
+                self.current_job = job
+                try:
+                    job.result = job.func(*job.args)
+                    job.status = Job.CANCELLED if job.cancelled else Job.DONE
+                except Exception as e:
+                    job.error = e
+                    job.status = Job.FAILED
+                finally:
+                    self.current_job = None
+            if job.on_complete: self.post_message("JOB_DONE", job)
+
+# --- Async Engine ---
+class AsyncEngine:
+    # Streams replies for every tab on one asyncio loop in a background thread. A reply
+    # is a task rather than a thread, so idle tabs cost nothing and replies in several
+    # tabs stream side by side; at most max_active run at once, later ones wait.
+    def __init__(self, post_message, max_active=MAX_CONCURRENT_REPLIES):
+        self.post_message = post_message
+        self.max_active = max_active
+        self.slots = None # Created on the loop, which asyncio primitives belong to
+        self.waiting = 0
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def submit(self, func, *args, on_complete=None):
+        job = Job(func, args, JOB_PRIORITY_NORMAL, on_complete)
+        asyncio.run_coroutine_threadsafe(self.run(job), self.loop)
+        return job
+
+    def cancel(self, job):
+        job.cancel()
+        self.loop.call_soon_threadsafe(self._cancel_task, job)
+
+    def queue_depth(self):
+        return self.waiting
+
+    def _cancel_task(self, job):
+        if job.task: job.task.cancel()
+
+    async def run(self, job):
+        job.task = asyncio.current_task()
+        if self.slots is None: self.slots = asyncio.Semaphore(self.max_active)
+        try:
+            self.waiting += 1
+            try: await self.slots.acquire()
+            finally: self.waiting -= 1
+            try:
+                if job.cancelled: raise asyncio.CancelledError # Stopped before its task started
+                job.status = Job.RUNNING
+                job.result = await job.func(*job.args)
+                job.status = Job.DONE
+            finally:
+                self.slots.release()
+        except asyncio.CancelledError:
+            job.status = Job.CANCELLED
+        except Exception as e:
+            job.error = e
+            job.status = Job.FAILED
+        finally:
+            job.task = None
+        if job.on_complete: self.post_message("JOB_DONE", job)
+
+# --- Batch Mode ---
+def read_batch_prompts(prompts_path):
+    with open(prompts_path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip(): continue
+            try: item = json.loads(line)
+            except json.JSONDecodeError as e: item = {'invalid': f"line {line_number} is not valid JSON ({e})"}
+            if isinstance(item, str): item = {'prompt': item}
+            elif not isinstance(item, dict): item = {'invalid': f"line {line_number} is not a JSON object or string"}
+            item.setdefault('id', line_number)
+            yield item
+
+def read_completed_batch_ids(output_path):
+    completed = set()
+    if not os.path.exists(output_path): return completed
+    with open(output_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try: result = json.loads(line)
+            except json.JSONDecodeError: continue # Torn last line from an interrupted run
+            if result.get('error') is None: completed.add(json.dumps(result.get('id')))
+            else: completed.discard(json.dumps(result.get('id')))
+    return completed
+
+def run_batch_item(model, item, safety_settings):
+    result = {'id': item['id'], 'prompt': item.get('prompt'), 'response': None, 'error': None,
+              'ttft_ms': None, 'latency_ms': None, 'chunks': 0}
+    started = time.perf_counter()
+    parts = []
+    try:
+        # Bad items get an error result like failed requests, instead of stopping the run
+        if 'invalid' in item: raise ValueError(item['invalid'])
+        if not isinstance(item.get('prompt'), str): raise ValueError("item has no 'prompt' string")
+        if not isinstance(item.get('history', []), list): raise ValueError("'history' must be a list")
+        session = model.start_chat(history=item.get('history', []))
+        for chunk in session.send_message(item['prompt'], stream=True, safety_settings=safety_settings):
+            if result['ttft_ms'] is None: result['ttft_ms'] = round((time.perf_counter() - started) * 1000, 1)
+            result['chunks'] += 1
+            try: parts.append(chunk.text)
+            except ValueError: # Blocked or empty candidate
+                feedback = getattr(chunk, 'prompt_feedback', None)
+                if feedback and feedback.block_reason: result['error'] = f"Blocked: {feedback.block_reason}"
+        result['response'] = "".join(parts)
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+    result['latency_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    return result
+
+def run_batch(prompts_path, output_path=None, concurrency=DEFAULT_BATCH_CONCURRENCY, model_name=None):
+    # Headless mode: same config, backend and safety settings as the GUI, prompts run
+    # with bounded concurrency and results appended as they finish, so a rerun resumes.
+    config = load_config()
+    output_path = output_path or os.path.splitext(prompts_path)[0] + ".results.jsonl"
+    model_name = model_name or config.get(SETTINGS_SECTION, MODEL_OPTION, fallback=DEFAULT_MODEL)
+    api_key = config.get(API_SECTION, API_KEY_OPTION, fallback="")
+    if config.get(SETTINGS_SECTION, BACKEND_OPTION, fallback=DEFAULT_BACKEND) != "mock" and not api_key:
+        print(f"No API key in {CONFIG_FILE}; run the app once or add {API_KEY_OPTION} under [{API_SECTION}].", file=sys.stderr)
+        return 2
+    backend = create_backend(config)
+    backend.configure(api_key)
+    model = backend.create_model(model_name)
+    completed = read_completed_batch_ids(output_path)
+    write_lock = threading.Lock()
+    in_flight = threading.BoundedSemaphore(concurrency * 2) # Don't read the whole prompt file ahead
+    counts = {'done': 0, 'failed': 0, 'skipped': 0}
+
+    def finish(future):
+        try:
+            result = future.result()
+            result['model'] = model_name
+            with write_lock:
+                output.write(json.dumps(result, ensure_ascii=False) + "\n")
+                output.flush()
+                counts['failed' if result['error'] else 'done'] += 1
+                print(f"[batch] {counts['done']} done, {counts['failed']} failed, {counts['skipped']} skipped"
+                      f" - {result['id']}: {result['latency_ms']} ms", file=sys.stderr, flush=True)
+        finally:
+            in_flight.release() # Or the reader blocks forever once 2 * concurrency items went wrong
+
+    with open(output_path, 'a', encoding='utf-8') as output, \
+         concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for item in read_batch_prompts(prompts_path):
+            if json.dumps(item['id']) in completed:
+                counts['skipped'] += 1
+                continue
+            in_flight.acquire()
+            pool.submit(run_batch_item, model, item, SAFETY_SETTINGS).add_done_callback(finish)
+    print(f"[batch] finished: {counts['done']} done, {counts['failed']} failed, {counts['skipped']} skipped -> {output_path}",
+          file=sys.stderr)
+    return 1 if counts['failed'] else 0
+
+# --- Benchmarks ---
+def use_data_dir(config_dir):
+    # Points chat storage (files, catalog and archive) somewhere else, so --benchmark never touches real chats
+    global CONFIG_DIR, CHATS_DIR, _catalog, _archive
+    if _catalog: _catalog.conn.close()
+    CONFIG_DIR = config_dir
+    CHATS_DIR = os.path.join(config_dir, "chats")
+    ensure_chats_dir()
+    _catalog = ChatCatalog(os.path.join(config_dir, "catalog.sqlite3"))
+    _archive = ChatArchive(os.path.join(config_dir, "archive.zip"))
+
+def synthetic_records(rng, turns):
+    return [{'role': 'user' if turn % 2 == 0 else 'model',
+             'content': " ".join(rng.choices(MOCK_WORDS, k=rng.randint(5, 12) if turn % 2 == 0 else rng.randint(20, 120)))}
+            for turn in range(turns)]
+
+def write_synthetic_chats(directory, count, turns=6, seed=0):
+    rng = random.Random(seed)
+    now = time.time()
+    for i in range(count):
+        path = os.path.join(directory, f"Chat_{i:06d}{CHAT_EXTENSION}")
+        with open(path, 'w', encoding='utf-8') as f:
+            for record in synthetic_records(rng, turns): f.write(json.dumps(record) + "\n")
+        os.utime(path, (now - i, now - i)) # Distinct ages keep the listing order deterministic
+
+class BenchmarkHost:
+    # Just enough of GeminiChatApp to run its sidebar and transcript methods on a
+    # real Tk root. create() returns None without a display (run under xvfb-run).
+    @classmethod
+    def create(cls):
+        try: root = ctk.CTk()
+        except tk.TclError: return None
+        return cls(root)
+
+    def __init__(self, root):
+        self.root = root
+        root.geometry("950x650")
+        self.base_font_family, self.base_font_size = "Arial", 12
+        self.chat_font = ctk.CTkFont(family=self.base_font_family, size=self.base_font_size)
+        self.chat_list = ChatListView(root, font=ctk.CTkFont(family="Arial", size=11), on_load=lambda path: None, on_delete=lambda path: None)
+        self.chat_list.pack(side="left", fill="y")
+        textbox = GeminiChatApp.create_chat_display(self, root)
+        textbox.pack(side="left", fill="both", expand=True)
+        self.tab = ChatTab("Benchmark", textbox, ContextWindow(DEFAULT_CONTEXT_TOKEN_BUDGET))
+        root.update()
+
+    def load_chat_list(self):
+        GeminiChatApp.load_chat_list(self)
+        self.root.update()
+
+    def load_transcript(self, messages):
+        self.tab.transcript.load(messages)
+        self.root.update()
+
+    def display_messages(self, records):
+        for record in records:
+            GeminiChatApp.display_message(self, record['content'], "bot" if record['role'] == "model" else "user", tab=self.tab)
+        self.root.update()
+
+    def close(self):
+        self.root.destroy()
+
+class BenchmarkRun:
+    # Collects timings and judges each against its budget and, if given, the same
+    # benchmark in a baseline report (minus BENCHMARK_TOLERANCE of slack).
+    def __init__(self, repeat, baseline=None):
+        self.repeat = repeat
+        self.baseline = {(result['name'], result['size']): result['median_ms']
+                         for result in (baseline or {}).get('results', []) if result.get('median_ms') is not None}
+        self.results = []
+
+    def measure(self, name, size, func, setup=None, repeat=None):
+        runs = []
+        for _ in range(repeat or self.repeat):
+            if setup: setup()
+            started = time.perf_counter()
+            func()
+            runs.append(round((time.perf_counter() - started) * 1000, 2))
+        median = statistics.median(runs)
+        fixed, per_item = BENCHMARK_BUDGETS_MS[name]
+        threshold = fixed + per_item * size
+        baseline = self.baseline.get((name, size))
+        if baseline is not None:
+            threshold = min(threshold, max(baseline * (1 + BENCHMARK_TOLERANCE), baseline + BENCHMARK_NOISE_MS))
+        status = "ok" if median <= threshold else "regressed"
+        self.results.append({'name': name, 'size': size, 'runs_ms': runs, 'median_ms': median, 'min_ms': min(runs),
+                             'baseline_ms': baseline, 'threshold_ms': round(threshold, 2), 'status': status})
+        print(f"[benchmark] {name:<26} {size:>8,} {median:10.1f} ms  (threshold {threshold:.1f} ms) {status}", file=sys.stderr, flush=True)
+
+    def skip(self, name, size, reason):
+        self.results.append({'name': name, 'size': size, 'runs_ms': [], 'median_ms': None, 'min_ms': None,
+                             'baseline_ms': self.baseline.get((name, size)), 'threshold_ms': None, 'status': "skipped", 'reason': reason})
+        print(f"[benchmark] {name:<26} {size:>8,} skipped: {reason}", file=sys.stderr, flush=True)
+
+def git_commit():
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, timeout=5)
+    except (OSError, subprocess.SubprocessError): return None
+    return result.stdout.strip() or None
+
+def run_benchmarks(output_path="-", chat_counts=BENCHMARK_CHAT_COUNTS, turn_counts=BENCHMARK_TURN_COUNTS, repeat=3, baseline_path=None):
+    # Times the storage, sidebar and transcript hot paths on synthetic data in a
+    # temporary directory. Returns 1 if anything regressed, for use in CI.
+    baseline = None
+    if baseline_path:
+        with open(baseline_path, 'r', encoding='utf-8') as f: baseline = json.load(f)
+    run = BenchmarkRun(repeat, baseline)
+    host = BenchmarkHost.create()
+    no_display = "no display (run under xvfb-run)"
+    with tempfile.TemporaryDirectory(prefix="gemini_chat_benchmark_") as root:
+        for count in chat_counts:
+            use_data_dir(os.path.join(root, f"tree_{count}"))
+            write_synthetic_chats(CHATS_DIR, count)
+            run.measure("catalog_reconcile", count, reconcile_chat_catalog, repeat=1) # Cold catalog build
+            run.measure("get_chat_files", count, get_chat_files)
+            if host: run.measure("load_chat_list", count, host.load_chat_list)
+            else: run.skip("load_chat_list", count, no_display)
+        use_data_dir(os.path.join(root, "long_chats"))
+        rng = random.Random(1)
+        for turns in turn_counts:
+            records = synthetic_records(rng, turns)
+            path = os.path.join(CHATS_DIR, f"Long_{turns}{CHAT_EXTENSION}")
+            run.measure("save_chat_to_file.compact", turns, lambda: (save_chat_to_file(records, path), flush_chat_writes()))
+            history = MessageStore(Message(record['role'], record['content']) for record in records)
+            exchange = synthetic_records(rng, 2)
+            def append_exchange():
+                for record in exchange: history.append(Message(record['role'], record['content']))
+                save_chat_to_file(history, path, append_from=len(history) - len(exchange))
+                flush_chat_writes()
+            run.measure("save_chat_to_file.append", turns, append_exchange)
+            run.measure("load_chat_from_file", turns, lambda: load_chat_from_file(path))
+            if host:
+                run.measure("transcript_load", turns, lambda: host.load_transcript(history.messages))
+                run.measure("display_message", turns, lambda: host.display_messages(records[-BENCHMARK_DISPLAY_MESSAGES:]),
+                            setup=lambda: host.load_transcript(history.messages))
+            else:
+                run.skip("transcript_load", turns, no_display)
+                run.skip("display_message", turns, no_display)
+        if _catalog: _catalog.conn.close()
+    if host: host.close()
+    report = {'generated': datetime.datetime.now().isoformat(timespec="seconds"), 'commit': git_commit(),
+              'python': sys.version.split()[0], 'platform': sys.platform, 'repeat': repeat,
+              'tolerance': BENCHMARK_TOLERANCE, 'baseline': baseline.get('commit') if baseline else None,
+              'results': run.results}
+    data = json.dumps(report, indent=2)
+    if output_path == "-": print(data)
+    else:
+        with open(output_path, 'w', encoding='utf-8') as f: f.write(data + "\n")
+    regressed = [result['name'] for result in run.results if result['status'] == "regressed"]
+    if regressed: print(f"[benchmark] regressions: {', '.join(sorted(set(regressed)))}", file=sys.stderr)
+    return 1 if regressed else 0
+
 # --- Settings Window ---
 class SettingsWindow(ctk.CTkToplevel):
     def __init__(self, parent):
@@ -138,7 +2708,7 @@ class SettingsWindow(ctk.CTkToplevel):
         self.config = parent.config
 
         self.title("Settings")
-        self.geometry("450x400")
+        self.geometry("520x440")
         self.transient(parent)
         self.grab_set()
 
@@ -158,6 +2728,13 @@ class SettingsWindow(ctk.CTkToplevel):
         model_dropdown = ctk.CTkOptionMenu(model_frame, variable=self.model_var, values=AVAILABLE_MODELS)
         model_dropdown.pack(side="left", fill="x", expand=True)
 
+        backend_frame = ctk.CTkFrame(self)
+        backend_frame.pack(fill="x", padx=20, pady=5)
+        ctk.CTkLabel(backend_frame, text="Backend:").pack(side="left", padx=(0, 10))
+        self.backend_var = tk.StringVar(value=self.config.get(SETTINGS_SECTION, BACKEND_OPTION, fallback=DEFAULT_BACKEND))
+        backend_dropdown = ctk.CTkOptionMenu(backend_frame, variable=self.backend_var, values=AVAILABLE_BACKENDS)
+        backend_dropdown.pack(side="left", fill="x", expand=True)
+
         appearance_frame = ctk.CTkFrame(self)
         appearance_frame.pack(fill="x", padx=20, pady=5)
         ctk.CTkLabel(appearance_frame, text="Appearance Mode:").pack(side="left", padx=(0, 10))
@@ -177,6 +2754,9 @@ class SettingsWindow(ctk.CTkToplevel):
         button_frame = ctk.CTkFrame(self, fg_color="transparent")
         button_frame.pack(pady=(20, 10))
 
+        metrics_button = ctk.CTkButton(button_frame, text="Export Metrics...", command=lambda: self.parent_app.export_metrics(), fg_color="gray")
+        metrics_button.pack(side="left", padx=10)
+
         save_button = ctk.CTkButton(button_frame, text="Save & Close", command=self.save_and_close)
         save_button.pack(side="left", padx=10)
 
@@ -192,26 +2772,230 @@ class SettingsWindow(ctk.CTkToplevel):
         current_model = self.config.get(SETTINGS_SECTION, MODEL_OPTION)
         model_changed = new_model != current_model
 
+        new_backend = self.backend_var.get()
+        backend_changed = new_backend != self.config.get(SETTINGS_SECTION, BACKEND_OPTION, fallback=DEFAULT_BACKEND)
+
         self.config.set(API_SECTION, API_KEY_OPTION, new_api_key)
+        self.config.set(SETTINGS_SECTION, BACKEND_OPTION, new_backend)
         self.config.set(SETTINGS_SECTION, APPEARANCE_OPTION, self.appearance_var.get())
         self.config.set(SETTINGS_SECTION, THEME_OPTION, self.theme_var.get())
         self.config.set(SETTINGS_SECTION, MODEL_OPTION, new_model)
 
         if save_config(self.config):
             messagebox.showinfo("Settings Saved", "Settings have been saved.", parent=self)
-            if api_key_changed or model_changed:
+            if api_key_changed or model_changed or backend_changed:
                 self.parent_app.reconfigure_api_from_settings()
             self.destroy()
         else:
             messagebox.showerror("Error", "Failed to save settings.", parent=self)
 
 
+# --- Search Results Window ---
+class SearchResultsWindow(ctk.CTkToplevel):
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.parent_app = parent
+
+        self.title("Search")
+        self.geometry("500x400")
+        self.transient(parent)
+
+        self.summary_label = ctk.CTkLabel(self, text="", anchor="w")
+        self.summary_label.pack(fill="x", padx=10, pady=(10, 0))
+        self.results_frame = ctk.CTkScrollableFrame(self, fg_color="transparent")
+        self.results_frame.pack(fill="both", expand=True, padx=10, pady=10)
+        self.results_frame.grid_columnconfigure(0, weight=1)
+
+    def show_results(self, query, results):
+        self.title(f"Search: {query}")
+        self.summary_label.configure(text=f"{len(results)} match(es) for '{query}'")
+        for widget in self.results_frame.winfo_children():
+            widget.destroy()
+        for i, result in enumerate(results):
+            speaker = "You" if result['role'] == 'user' else "Gemini"
+            snippet = " ".join(result['snippet'].split())
+            result_button = ctk.CTkButton(
+                self.results_frame, text=f"{result['title']} - {speaker}: {snippet}", anchor="w",
+                font=self.parent_app.chatlist_font, fg_color="transparent", hover_color=("#dbdbdb", "#2b2b2b"),
+                text_color=("gray10", "gray90"),
+                command=lambda r=result: self.parent_app.open_search_result(r['filename'], r['turn'])
+            )
+            result_button.grid(row=i, column=0, pady=(0, 2), sticky="ew")
+        self.focus()
+
+# --- Compare Window ---
+class CompareColumn:
+    # One model's side of a comparison: its streamed answer, stats and Keep button
+    def __init__(self, window, model_name):
+        app = window.parent_app
+        self.model_name = model_name
+        self.metrics = RequestMetrics(model_name)
+        self.job = None
+        self.finished = False
+        self.closed = False
+        self.frame = ctk.CTkFrame(window.columns_frame)
+        self.frame.grid_columnconfigure(0, weight=1)
+        self.frame.grid_rowconfigure(2, weight=1)
+        ctk.CTkLabel(self.frame, text=model_name, font=app.sidebar_font).grid(row=0, column=0, padx=5, pady=(5, 0), sticky="w")
+        self.stats_label = ctk.CTkLabel(self.frame, text="Waiting...", anchor="w", font=app.status_font)
+        self.stats_label.grid(row=1, column=0, padx=5, sticky="ew")
+        textbox = app.create_chat_display(self.frame)
+        textbox.grid(row=2, column=0, padx=5, pady=5, sticky="nsew")
+        self.transcript = TranscriptView(textbox)
+        self.reply = Message('model')
+        self.transcript.append(self.reply, streaming=True)
+        self.keep_button = ctk.CTkButton(self.frame, text="Keep this answer", state=tk.DISABLED, command=lambda: window.keep(self))
+        self.keep_button.grid(row=3, column=0, padx=5, pady=(0, 5), sticky="ew")
+
+    def update_stats(self, status=None):
+        metrics = self.metrics
+        parts = [status] if status else []
+        if metrics.ttft() is not None: parts.append(f"TTFT {metrics.ttft() * 1000:.0f} ms")
+        if metrics.sent:
+            end = metrics.stream_end or (metrics.rendered if self.finished else time.perf_counter())
+            parts.append(f"{end - metrics.sent:.1f} s")
+            parts.append(f"{metrics.chars:,} chars")
+        self.stats_label.configure(text=" | ".join(parts) or "Waiting...")
+
+class CompareWindow(ctk.CTkToplevel):
+    # Sends one prompt to several models at once and streams the answers side by side.
+    # The current tab's history is the context for all of them, and any one answer can
+    # be kept in that tab afterwards.
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.parent_app = parent
+        self.tab = None
+        self.prompt = None
+        self.history_length = 0 # Messages in self.tab when the comparison was sent
+        self.columns = []
+        self.tick_job = None
+
+        self.title("Compare Models")
+        self.geometry("1000x600")
+        self.transient(parent)
+
+        models_frame = ctk.CTkFrame(self, fg_color="transparent")
+        models_frame.pack(fill="x", padx=10, pady=(10, 0))
+        ctk.CTkLabel(models_frame, text="Models:").pack(side="left", padx=(0, 10))
+        self.model_vars = {}
+        for model_name in AVAILABLE_MODELS:
+            self.model_vars[model_name] = tk.BooleanVar(value=True)
+            ctk.CTkCheckBox(models_frame, text=model_name, variable=self.model_vars[model_name]).pack(side="left", padx=(0, 10))
+
+        input_frame = ctk.CTkFrame(self, fg_color="transparent")
+        input_frame.pack(fill="x", padx=10, pady=5)
+        self.prompt_entry = ctk.CTkEntry(input_frame, placeholder_text="Prompt for every selected model...", font=parent.input_font, height=36)
+        self.prompt_entry.pack(side="left", fill="x", expand=True)
+        self.prompt_entry.bind("<Return>", lambda event: self.send())
+        self.send_button = ctk.CTkButton(input_frame, text="Compare", width=90, height=36, command=self.send)
+        self.send_button.pack(side="left", padx=(5, 0))
+        self.stop_button = ctk.CTkButton(input_frame, text="Stop", width=50, height=36, state=tk.DISABLED,
+                                         fg_color="#AA3333", hover_color="#882222", command=self.stop)
+        self.stop_button.pack(side="left", padx=(5, 0))
+
+        self.columns_frame = ctk.CTkFrame(self, fg_color="transparent")
+        self.columns_frame.pack(fill="both", expand=True, padx=5, pady=(0, 5))
+        self.columns_frame.grid_rowconfigure(0, weight=1)
+        self.protocol("WM_DELETE_WINDOW", self.close)
+
+    def running(self):
+        return any(column.job and not column.finished for column in self.columns)
+
+    def send(self):
+        prompt = self.prompt_entry.get().strip()
+        model_names = [model_name for model_name, var in self.model_vars.items() if var.get()]
+        if not prompt or not model_names or self.running(): return
+        app = self.parent_app
+        if not app.api_ready:
+            messagebox.showinfo("Compare Models", "API not ready.", parent=self)
+            return
+        if app.tab.loading:
+            messagebox.showinfo("Compare Models", "The current chat is still loading.", parent=self)
+            return
+        self.clear_columns()
+        self.tab = app.tab
+        self.prompt = prompt
+        history = self.tab.messages.snapshot()
+        self.history_length = len(history)
+        for i, model_name in enumerate(model_names):
+            column = CompareColumn(self, model_name)
+            column.frame.grid(row=0, column=i, padx=5, pady=5, sticky="nsew")
+            self.columns_frame.grid_columnconfigure(i, weight=1, uniform="compare")
+            column.job = app.engine.submit(app.compare_reply_async, column, prompt, history, on_complete=self.on_reply_finished)
+            self.columns.append(column)
+        self.send_button.configure(state=tk.DISABLED)
+        self.stop_button.configure(state=tk.NORMAL)
+        self.tick()
+
+    def tick(self):
+        # Keeps the elapsed times moving while answers stream
+        self.tick_job = None
+        for column in self.columns:
+            if not column.finished: column.update_stats()
+        if self.running(): self.tick_job = self.after(250, self.tick)
+
+    def on_chunk(self, column, text):
+        if column.closed: return
+        column.transcript.extend_last(text)
+        column.transcript.textbox.see(tk.END)
+        column.metrics.on_render()
+
+    def on_reply_finished(self, job):
+        column = job.args[0]
+        metrics = column.metrics
+        column.finished = True
+        if job.status == Job.CANCELLED: metrics.outcome = "cancelled"
+        elif job.status == Job.FAILED or metrics.outcome is None: metrics.outcome = "error"
+        if metrics.rendered is None: metrics.rendered = time.perf_counter()
+        self.parent_app.metrics.record(metrics)
+        if column.closed: return
+        column.transcript.close_last()
+        if job.status == Job.FAILED:
+            column.transcript.append(format_transcript_entry(f"{type(job.error).__name__}: {str(job.error)[:300]}", "error"))
+        column.update_stats({"cancelled": "Stopped", "error": "Failed", "blocked": "Blocked"}.get(metrics.outcome))
+        if metrics.outcome == "ok" and column.reply.text: column.keep_button.configure(state=tk.NORMAL)
+        if not self.running():
+            self.send_button.configure(state=tk.NORMAL)
+            self.stop_button.configure(state=tk.DISABLED)
+
+    def keep(self, column):
+        tab = self.tab
+        if tab is None or tab.closed:
+            messagebox.showinfo("Compare Models", "The chat this comparison was made in has been closed.", parent=self)
+            return
+        if tab.request or tab.loading or len(tab.messages) != self.history_length:
+            messagebox.showinfo("Compare Models", "That chat has changed since the comparison was sent.", parent=self)
+            return
+        self.parent_app.keep_answer(tab, self.prompt, column.reply.text, column.model_name)
+        for other in self.columns: other.keep_button.configure(state=tk.DISABLED)
+        column.keep_button.configure(text="Kept")
+
+    def stop(self):
+        for column in self.columns:
+            if column.job and not column.finished: self.parent_app.engine.cancel(column.job)
+        self.stop_button.configure(state=tk.DISABLED)
+
+    def clear_columns(self):
+        for i, column in enumerate(self.columns):
+            column.closed = True
+            column.frame.destroy()
+            self.columns_frame.grid_columnconfigure(i, weight=0, uniform="")
+        self.columns = []
+
+    def close(self):
+        self.stop()
+        if self.tick_job: self.after_cancel(self.tick_job)
+        self.clear_columns()
+        self.destroy()
+
 # --- Main Application Class ---
 class GeminiChatApp(ctk.CTk):
     def __init__(self):
-        super().__init__()
+        with startup_profile.stage("tk root"):
+            super().__init__()
 
-        self.config = load_config()
+        with startup_profile.stage("config"):
+            self.config = load_config()
 
         self.title(APP_NAME)
         self.geometry("950x650")
@@ -231,27 +3015,81 @@ class GeminiChatApp(ctk.CTk):
         self.chatlist_font = ctk.CTkFont(family=self.base_font_family, size=11)
 
         self.api_key = None
+        self.backend = None
+        self.backend_settings = None # (backend, mock URL, API key) self.backend was configured with
         self.model = None
-        self.chat = None
+        self.model_pool = LRUPool(MODEL_POOL_SIZE) # Model name -> model object for self.backend
+        self.session_pool = LRUPool(SESSION_POOL_SIZE, SESSION_POOL_MB * 1024 * 1024, pooled_chat_size) # Chat file -> (MessageStore, transcript entries)
         self.api_ready = False
         self.message_queue = queue.Queue()
-        self.last_bot_response = ""
+        self.queue_wakeup = threading.Event()
+        self.wakeup_pipe = self.create_wakeup_pipe() # Before any worker can post
+        self.executor = RequestExecutor(self.post_message) # SDK import, configuration and session setup
+        self.engine = AsyncEngine(self.post_message) # Streaming replies for all tabs
+        self.rate_limiter = RateLimiter(self.config.getint(SETTINGS_SECTION, REQUESTS_PER_MINUTE_OPTION, fallback=DEFAULT_REQUESTS_PER_MINUTE),
+                                        on_change=lambda: self.post_message("RATE_STATS"))
+        self.metrics = MetricsRegistry()
+        # At least 1 ms, or no drain would ever handle a message and the queue would only grow
+        self.frame_budget_ms = max(1, self.config.getint(SETTINGS_SECTION, FRAME_BUDGET_OPTION, fallback=DEFAULT_FRAME_BUDGET_MS))
+        stall_threshold_ms = self.config.getint(SETTINGS_SECTION, STALL_THRESHOLD_OPTION, fallback=DEFAULT_STALL_THRESHOLD_MS)
+        self.watchdog = StallWatchdog(self, stall_threshold_ms, self.metrics) if stall_threshold_ms > 0 else None
         self.safety_settings = []
         self.current_model_name = self.config.get(SETTINGS_SECTION, MODEL_OPTION, fallback=DEFAULT_MODEL)
+        self.response_cache = None
+        if self.config.getboolean(SETTINGS_SECTION, RESPONSE_CACHE_OPTION, fallback=False):
+            try:
+                cache_mb = self.config.getint(SETTINGS_SECTION, RESPONSE_CACHE_SIZE_OPTION, fallback=DEFAULT_RESPONSE_CACHE_MB)
+                self.response_cache = ResponseCache(max_bytes=cache_mb * 1024 * 1024)
+            except OSError: pass
 
-        self.current_chat_file = None
-        self.chat_is_dirty = False
+        self.tabs = {} # Tab name -> ChatTab, in tab order
+        self.tab = None # Selected ChatTab
+        self.autosave_delay_ms = self.config.getint(SETTINGS_SECTION, AUTOSAVE_OPTION, fallback=DEFAULT_AUTOSAVE_DELAY_MS)
+        self.retrieval = self.config.getboolean(SETTINGS_SECTION, RETRIEVAL_OPTION, fallback=False)
+        self.retrieval_token_budget = self.config.getint(SETTINGS_SECTION, RETRIEVAL_BUDGET_OPTION, fallback=DEFAULT_RETRIEVAL_TOKEN_BUDGET)
 
         self.sidebar_visible = True
         self.settings_window = None
-
-        self.send_icon = load_icon(SEND_ICON_B64)
-
-        self.create_widgets()
-        self.load_chat_list()
-
-        threading.Thread(target=self.setup_api, daemon=True).start()
-        self.after(100, self.process_message_queue)
+        self.search_window = None
+        self.compare_window = None
+
+        with startup_profile.stage("widgets"):
+            self.send_icon = load_icon(SEND_ICON_B64)
+            self.create_widgets()
+
+        self.bind("<Control-t>", lambda event: self.new_tab())
+        self.bind("<Control-w>", lambda event: self.close_tab())
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+        get_chat_writer().on_error = lambda message: self.post_message("DISPLAY_MSG", (message, "error"))
+        # Everything else waits until the window has painted (idle handlers run in order)
+        self.after_idle(self.start_deferred_stages)
+        self.after(QUEUE_IDLE_POLL_MS, self.poll_message_queue)
+
+    def start_deferred_stages(self):
+        startup_profile.mark("first paint")
+        if self.watchdog: self.watchdog.start() # Before the chat list, which is one of the things it watches
+        with startup_profile.stage("chat list (cached)"):
+            self.load_chat_list() # Last known catalog state; reconciled in the background below
+        threading.Thread(target=self.refresh_catalog_thread, daemon=True).start()
+        self.executor.submit(self.setup_api, priority=JOB_PRIORITY_HIGH)
+
+    def refresh_catalog_thread(self):
+        with startup_profile.stage("catalog reconcile"):
+            reconcile_chat_catalog()
+        max_age_days = self.config.getint(SETTINGS_SECTION, ARCHIVE_AGE_OPTION, fallback=DEFAULT_ARCHIVE_AFTER_DAYS)
+        with startup_profile.stage("archive old chats"):
+            archive_old_chats(max_age_days, is_open=self.is_chat_open)
+        if self.retrieval:
+            with startup_profile.stage("retrieval index"):
+                index = get_retrieval_index()
+                if index:
+                    try: index.update() # So the first send only embeds what changed since
+                    except (OSError, ValueError, sqlite3.Error): pass
+        self.post_message("REFRESH_CHAT_LIST", None)
+
+    def is_chat_open(self, filename):
+        # Also called from the catalog thread, hence the snapshot of the tabs
+        return any(tab.chat_file and os.path.basename(tab.chat_file) == filename for tab in list(self.tabs.values()))
 
     def create_widgets(self):
         self.grid_columnconfigure(0, weight=0, minsize=SIDEBAR_WIDTH if self.sidebar_visible else 0)
@@ -278,10 +3116,20 @@ class GeminiChatApp(ctk.CTk):
         new_chat_button.grid(row=0, column=0, padx=(0,5), pady=0, sticky="w")
         save_chat_button = ctk.CTkButton(button_frame, text="Save", command=self.save_current_chat, width=SIDEBAR_WIDTH//2 - 15)
         save_chat_button.grid(row=0, column=1, padx=(5,0), pady=0, sticky="e")
+        new_tab_button = ctk.CTkButton(button_frame, text="New Tab", command=self.new_tab, width=SIDEBAR_WIDTH//2 - 15)
+        new_tab_button.grid(row=1, column=0, padx=(0,5), pady=(5,0), sticky="w")
+        close_tab_button = ctk.CTkButton(button_frame, text="Close Tab", command=self.close_tab, width=SIDEBAR_WIDTH//2 - 15)
+        close_tab_button.grid(row=1, column=1, padx=(5,0), pady=(5,0), sticky="e")
+        compare_button = ctk.CTkButton(button_frame, text="Compare Models", command=self.open_compare_window)
+        compare_button.grid(row=2, column=0, columnspan=2, pady=(5,0), sticky="ew")
+
+        self.chat_list = ChatListView(self.sidebar_frame, font=self.chatlist_font, on_load=self.load_chat, on_delete=self.delete_chat,
+                                      on_more=self.load_archived_chats)
+        self.search_entry = ctk.CTkEntry(self.sidebar_frame, placeholder_text="Search chats...", font=self.chatlist_font)
+        self.search_entry.grid(row=2, column=0, columnspan=2, padx=10, pady=(5,0), sticky="ew")
+        self.search_entry.bind("<Return>", self.search_chats)
 
-        self.chat_list_frame = ctk.CTkScrollableFrame(self.sidebar_frame, label_text="History", fg_color="transparent")
-        self.chat_list_frame.grid(row=2, column=0, columnspan=2, padx=5, pady=(5,5), sticky="nsew")
-        self.chat_list_frame.grid_columnconfigure(0, weight=1)
+        self.chat_list.grid(row=3, column=0, columnspan=2, padx=5, pady=(5,5), sticky="nsew")
 
         settings_button = ctk.CTkButton(self.sidebar_frame, text="Settings", command=self.open_settings_window)
         settings_button.grid(row=4, column=0, columnspan=2, padx=10, pady=10, sticky="ew")
@@ -295,14 +3143,8 @@ class GeminiChatApp(ctk.CTk):
                                            hover_color=("#404040", "#404040")) # Slightly lighter hover
         self.toggle_button.grid(row=0, column=1, rowspan=3, sticky="ns")
 
-        self.chat_display = ctk.CTkTextbox(
-            self, wrap=tk.WORD, state=tk.DISABLED, font=self.chat_font, border_width=1
-        )
-        self.chat_display.grid(row=0, column=2, padx=(0, 10), pady=(10, 5), sticky="nsew")
-        self.chat_display.tag_config("user", foreground="#0077CC")
-        self.chat_display.tag_config("bot", foreground="#009955")
-        self.chat_display.tag_config("error", foreground="#CC0000")
-        self.chat_display.tag_config("info", foreground="#888888")
+        self.tabview = ctk.CTkTabview(self, command=self.on_tab_selected)
+        self.tabview.grid(row=0, column=2, padx=(0, 10), pady=(0, 5), sticky="nsew")
 
         self.input_frame = ctk.CTkFrame(self, fg_color="transparent")
         self.input_frame.grid(row=1, column=2, padx=(0, 10), pady=(0, 5), sticky="ew")
@@ -321,10 +3163,137 @@ class GeminiChatApp(ctk.CTk):
         )
         self.send_button.grid(row=0, column=1, padx=(0, 0), pady=5)
 
+        self.stop_button = ctk.CTkButton(
+            self.input_frame, text="Stop", command=self.stop_generation,
+            width=50, height=40, state=tk.DISABLED, fg_color="#AA3333", hover_color="#882222"
+        )
+        self.stop_button.grid(row=0, column=2, padx=(5, 0), pady=5)
+        self.bind("<Escape>", self.stop_generation)
+
+        self.status_frame = ctk.CTkFrame(self, fg_color="transparent")
+        self.status_frame.grid(row=2, column=2, padx=(0, 10), pady=(0, 5), sticky="ew")
+        self.status_frame.grid_columnconfigure(0, weight=1)
+
         self.status_bar = ctk.CTkLabel(
-            self, text="Initializing...", anchor="w", font=self.status_font
+            self.status_frame, text="Initializing...", anchor="w", font=self.status_font
         )
-        self.status_bar.grid(row=2, column=2, padx=(0, 10), pady=(0, 5), sticky="ew")
+        self.status_bar.grid(row=0, column=0, sticky="ew")
+
+        self.context_label = ctk.CTkLabel(self.status_frame, text="", anchor="e", font=self.status_font)
+        self.context_label.grid(row=0, column=1, padx=(10, 0), sticky="e")
+
+        self.cache_label = ctk.CTkLabel(self.status_frame, text="", anchor="e", font=self.status_font)
+        self.cache_label.grid(row=0, column=2, padx=(10, 0), sticky="e")
+
+        self.rate_label = ctk.CTkLabel(self.status_frame, text="", anchor="e", font=self.status_font)
+        self.rate_label.grid(row=0, column=3, padx=(10, 0), sticky="e")
+        self.update_rate_label()
+
+        self.speed_label = ctk.CTkLabel(self.status_frame, text="", anchor="e", font=self.status_font)
+        self.speed_label.grid(row=0, column=4, padx=(10, 0), sticky="e")
+
+        self.memory_label = ctk.CTkLabel(self.status_frame, text="", anchor="e", font=self.status_font)
+        self.memory_label.grid(row=0, column=5, padx=(10, 0), sticky="e")
+
+        self.new_tab()
+
+    def create_chat_display(self, master):
+        chat_display = ctk.CTkTextbox(
+            master, wrap=tk.WORD, state=tk.DISABLED, font=self.chat_font, border_width=1
+        )
+        chat_display.tag_config("user", foreground="#0077CC")
+        chat_display.tag_config("bot", foreground="#009955")
+        chat_display.tag_config("error", foreground="#CC0000")
+        chat_display.tag_config("info", foreground="#888888")
+        chat_display.tag_config("search_hit", background="#FFE08A")
+        # Markdown tags; fonts go to the inner tk.Text since CTkTextbox refuses them
+        dark = ctk.get_appearance_mode() == "Dark"
+        family, size = self.base_font_family, self.base_font_size
+        text = chat_display._textbox
+        text.tag_configure("md_h1", font=(family, size + 6, "bold"))
+        text.tag_configure("md_h2", font=(family, size + 4, "bold"))
+        text.tag_configure("md_h3", font=(family, size + 2, "bold"))
+        text.tag_configure("md_bold", font=(family, size, "bold"))
+        text.tag_configure("md_italic", font=(family, size, "italic"))
+        text.tag_configure("md_code", font=("Courier", size), background="#2B2B2B" if dark else "#EEEEEE")
+        text.tag_configure("md_code_block", font=("Courier", size), background="#1E1E1E" if dark else "#F4F4F4",
+                           foreground="#D4D4D4" if dark else "#333333", lmargin1=12, lmargin2=12)
+        text.tag_configure("md_fence", font=("Courier", size - 2), foreground="#888888")
+        text.tag_configure("md_list", lmargin1=12, lmargin2=28)
+        text.tag_configure("md_quote", lmargin1=16, lmargin2=16, foreground="#888888")
+        text.tag_raise("search_hit")
+        return chat_display
+
+    def new_tab(self):
+        name = self.unique_tab_name("New Chat")
+        frame = self.tabview.add(name)
+        frame.grid_columnconfigure(0, weight=1)
+        frame.grid_rowconfigure(0, weight=1)
+        chat_display = self.create_chat_display(frame)
+        chat_display.grid(row=0, column=0, sticky="nsew")
+        tab = ChatTab(name, chat_display, ContextWindow(context_budget_for(self.current_model_name, self.config)))
+        self.tabs[name] = tab
+        self.select_tab(tab)
+        return tab
+
+    def close_tab(self):
+        tab = self.tab
+        if not self._confirm_discard_changes(tab): return
+        if tab.request: self.engine.cancel(tab.request)
+        if tab.loading: tab.loading.cancel()
+        self.pool_session(tab)
+        tab.closed = True
+        del self.tabs[tab.name]
+        self.tabview.delete(tab.name)
+        if self.tabs: self.select_tab(self.tabs.get(self.tabview.get()) or next(iter(self.tabs.values())))
+        else: self.new_tab()
+        self.trim_memory()
+
+    def pool_session(self, tab):
+        # Saved chats stay live after their tab closes, so reopening one is instant
+        if tab.chat_file and not tab.dirty and not tab.request and not tab.loading:
+            self.session_pool.put(tab.chat_file, (tab.messages, tab.transcript.entries))
+
+    def trim_memory(self):
+        # Open tabs always keep their messages; pooled chats get what is left of the budget
+        open_bytes = sum(tab.messages.nbytes for tab in self.tabs.values())
+        pool_budget = max(0, MESSAGE_MEMORY_MB * 1024 * 1024 - open_bytes)
+        self.session_pool.resize(min(SESSION_POOL_MB * 1024 * 1024, pool_budget))
+        self.update_memory_label()
+
+    def unique_tab_name(self, title, tab=None):
+        name, number = title, 2
+        while name in self.tabs and self.tabs[name] is not tab:
+            name = f"{title} ({number})"
+            number += 1
+        return name
+
+    def rename_tab(self, tab, title):
+        name = self.unique_tab_name(title, tab)
+        if name == tab.name: return
+        self.tabview.rename(tab.name, name)
+        del self.tabs[tab.name]
+        tab.name = name
+        self.tabs[name] = tab
+
+    def find_tab(self, file_path):
+        return next((tab for tab in self.tabs.values() if tab.chat_file == file_path), None)
+
+    def select_tab(self, tab):
+        self.tabview.set(tab.name)
+        self.on_tab_selected()
+
+    def on_tab_selected(self):
+        tab = self.tabs.get(self.tabview.get())
+        if tab is None: return
+        self.tab = tab
+        self.update_status(tab.status)
+        self.update_context_label(tab.context_info)
+        self.update_speed_label(tab.metrics)
+        self.update_memory_label()
+        self.set_input_state(tk.DISABLED if tab.request or tab.loading else tk.NORMAL)
+        self.stop_button.configure(state=tk.NORMAL if tab.request and not tab.request.cancelled else tk.DISABLED)
+        self.input_entry.focus()
 
     def toggle_sidebar(self):
         self.sidebar_visible = not self.sidebar_visible
@@ -345,6 +3314,11 @@ class GeminiChatApp(ctk.CTk):
         else:
             self.settings_window.focus()
 
+    def open_compare_window(self):
+        if self.compare_window is None or not self.compare_window.winfo_exists():
+            self.compare_window = CompareWindow(self)
+        self.compare_window.focus()
+
     def change_appearance_mode(self, new_mode_str):
         ctk.set_appearance_mode(new_mode_str)
         self.appearance_mode = new_mode_str
@@ -358,19 +3332,31 @@ class GeminiChatApp(ctk.CTk):
         self.api_ready = False
         self.set_input_state(tk.DISABLED)
         self.current_model_name = self.config.get(SETTINGS_SECTION, MODEL_OPTION, fallback=DEFAULT_MODEL)
-        self.message_queue.put(("UPDATE_TITLE", None))
-        threading.Thread(target=self.setup_api, daemon=True).start()
+        self.post_message("UPDATE_TITLE", None)
+        self.executor.cancel_pending()
+        self.executor.submit(self.setup_api, priority=JOB_PRIORITY_HIGH)
         if messagebox.askyesno("Model Changed", "Model changed. Start new chat?", parent=self):
              self.new_chat(confirm_discard=False)
 
     def setup_api(self):
-        self.update_status("Loading API key...")
+        using_mock = self.config.get(SETTINGS_SECTION, BACKEND_OPTION, fallback=DEFAULT_BACKEND) == "mock"
+        if not using_mock:
+            self.post_message("STATUS_UPDATE", "Loading Gemini SDK...")
+            try:
+                with startup_profile.stage("sdk import"):
+                    import_genai()
+            except ImportError:
+                self.post_message("STATUS_UPDATE", "API Error!")
+                self.post_message("DISPLAY_MSG", ("google-generativeai is not installed.", "error"))
+                return
+        self.post_message("STATUS_UPDATE", "Loading API key...")
         self.api_key = self.config.get(API_SECTION, API_KEY_OPTION, fallback=None)
+        if using_mock and not self.api_key: self.api_key = "mock" # The local server doesn't check keys
         if not self.api_key:
-            self.message_queue.put(("PROMPT_API_KEY", None))
+            self.post_message("PROMPT_API_KEY", None)
             return
         self.current_model_name = self.config.get(SETTINGS_SECTION, MODEL_OPTION, fallback=DEFAULT_MODEL)
-        self.message_queue.put(("UPDATE_TITLE", None))
+        self.post_message("UPDATE_TITLE", None)
         self.configure_google_api()
 
     def prompt_for_api_key(self):
@@ -383,7 +3369,7 @@ class GeminiChatApp(ctk.CTk):
             if save_config(self.config):
                 self.api_key = api_key
                 self.update_status("API Key saved. Initializing model...")
-                threading.Thread(target=self.configure_google_api, daemon=True).start()
+                self.executor.submit(self.configure_google_api, priority=JOB_PRIORITY_HIGH)
             else:
                 self.update_status("Failed to save API Key.")
                 self.set_input_state(tk.DISABLED)
@@ -394,296 +3380,692 @@ class GeminiChatApp(ctk.CTk):
 
     def configure_google_api(self):
         if not self.api_key:
-             self.message_queue.put(("STATUS_UPDATE", "API Key missing."))
-             self.message_queue.put(("DISPLAY_MSG", ("Cannot configure API without key.", "error")))
+             self.post_message("STATUS_UPDATE", "API Key missing.")
+             self.post_message("DISPLAY_MSG", ("Cannot configure API without key.", "error"))
              self.set_input_state(tk.DISABLED)
              return
         try:
-            self.message_queue.put(("STATUS_UPDATE", f"Configuring {self.current_model_name}..."))
-            genai.configure(api_key=self.api_key)
-            self.model = genai.GenerativeModel(self.current_model_name)
-            self.safety_settings = [
-                {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-                {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-                {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-                {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-            ]
-            if self.current_chat_file is None:
-                 self.chat = self.model.start_chat(history=[])
-            else:
-                 loaded_history = load_chat_from_file(self.current_chat_file)
-                 if loaded_history:
-                     try:
-                          self.chat = self.model.start_chat(history=loaded_history)
-                     except Exception as start_chat_err:
-                           self.message_queue.put(("DISPLAY_MSG", (f"Error re-loading history.", "error")))
-                           self.chat = self.model.start_chat(history=[])
-                 else:
-                      self.chat = self.model.start_chat(history=[])
+            self.post_message("STATUS_UPDATE", f"Configuring {self.current_model_name}...")
+            configure_started = time.perf_counter()
+            backend_settings = (self.config.get(SETTINGS_SECTION, BACKEND_OPTION, fallback=DEFAULT_BACKEND),
+                                self.config.get(SETTINGS_SECTION, MOCK_URL_OPTION, fallback=""), self.api_key)
+            if backend_settings != self.backend_settings:
+                self.backend = create_backend(self.config)
+                self.backend.configure(self.api_key)
+                self.backend_settings = backend_settings
+                self.model_pool.clear() # Models are bound to the client they were first used with
+            self.model = self.model_pool.get(self.current_model_name)
+            if self.model is None:
+                self.model = self.backend.create_model(self.current_model_name)
+                self.model_pool.put(self.current_model_name, self.model)
+            self.safety_settings = list(SAFETY_SETTINGS)
+            context_budget = context_budget_for(self.current_model_name, self.config)
+            # Open tabs keep their history; replies are sent through a fresh session of the new model
+            for tab in list(self.tabs.values()):
+                 tab.context = ContextWindow(context_budget)
             self.api_ready = True
-            self.message_queue.put(("STATUS_UPDATE", "Ready."))
-            self.message_queue.put(("SET_INPUT_STATE", tk.NORMAL))
+            startup_profile.record("api configure", configure_started)
+            self.post_message("STATUS_UPDATE", "Ready.")
+            self.post_message("SET_INPUT_STATE", tk.NORMAL)
         except Exception as e:
             if "API key not valid" in str(e): error_msg_display = "Invalid API Key."
             elif "not found" in str(e).lower() and self.current_model_name in str(e): error_msg_display = f"Model '{self.current_model_name}' not found."
             else: error_msg_display = f"API Error: {type(e).__name__}."
-            self.message_queue.put(("STATUS_UPDATE", "API Error!"))
-            self.message_queue.put(("DISPLAY_MSG", (error_msg_display, "error")))
+            self.post_message("STATUS_UPDATE", "API Error!")
+            self.post_message("DISPLAY_MSG", (error_msg_display, "error"))
             self.api_ready = False
-            self.message_queue.put(("SET_INPUT_STATE", tk.DISABLED))
-
-    def display_message(self, message, tag="user", append_newlines=True):
-        self.chat_display.configure(state=tk.NORMAL)
-        prefix = ""
-        if tag == "user": prefix = "You: "
-        elif tag == "error": prefix = "Error: "
-        elif tag == "info": prefix = "[INFO] "
-        self.chat_display.insert(tk.END, f"{prefix}{message}", tag)
-        if append_newlines:
-             self.chat_display.insert(tk.END, "\n\n" if tag != "info" else "\n")
-        self.chat_display.configure(state=tk.DISABLED)
-        self.chat_display.see(tk.END)
-
-    def display_stream_chunk(self, chunk):
-        self.chat_display.configure(state=tk.NORMAL)
-        self.chat_display.insert(tk.END, chunk, "bot")
-        self.chat_display.configure(state=tk.DISABLED)
-        self.chat_display.see(tk.END)
-
-    def update_status(self, message):
-        dirty_indicator = "*" if self.chat_is_dirty else ""
-        filename = os.path.basename(self.current_chat_file) if self.current_chat_file else "New Chat"
+            self.post_message("SET_INPUT_STATE", tk.DISABLED)
+
+    def display_message(self, message, tag="user", append_newlines=True, tab=None):
+        tab = tab or self.tab
+        tab.transcript.append(format_transcript_entry(message, tag, append_newlines))
+        tab.textbox.see(tk.END)
+
+    def display_stream_chunk(self, chunk, tab=None):
+        tab = tab or self.tab
+        tab.transcript.extend_last(chunk, "bot") # Styled as Markdown by the transcript
+        tab.textbox.see(tk.END)
+
+    def update_status(self, message, tab=None):
+        tab = tab or self.tab
+        tab.status = message
+        if tab is not self.tab: return # Shown when that tab is selected
+        dirty_indicator = "*" if tab.dirty else ""
+        filename = os.path.basename(tab.chat_file) if tab.chat_file else "New Chat"
         self.status_bar.configure(text=f"{filename}{dirty_indicator} | {message}")
 
+    def update_context_label(self, context):
+        if context is None:
+            self.context_label.configure(text="")
+            return
+        tokens, budget, sent_messages, total_messages, retrieved = context
+        text = f"Context: ~{tokens:,}/{budget:,} tokens"
+        if sent_messages < total_messages: text += f" ({total_messages - sent_messages} older msgs summarized)"
+        if retrieved: text += f" | {retrieved[0]} past snippets in {retrieved[1]:.0f} ms"
+        self.context_label.configure(text=text)
+
+    def update_rate_label(self):
+        queued = self.rate_limiter.queue_depth() + self.engine.queue_depth()
+        rate = self.rate_limiter.rate_per_minute((self.current_model_name, self.api_key))
+        text = f"{rate:.1f}/{self.rate_limiter.requests_per_minute} req/min"
+        self.rate_label.configure(text=f"Queued: {queued} | {text}" if queued else text)
+
+    def update_speed_label(self, metrics):
+        parts = []
+        if metrics and metrics.ttft() is not None: parts.append(f"TTFT {metrics.ttft() * 1000:.0f} ms")
+        if metrics and metrics.tokens_per_second() is not None: parts.append(f"{metrics.tokens_per_second():.0f} tok/s")
+        self.speed_label.configure(text=" | ".join(parts))
+
+    def update_memory_label(self):
+        messages = self.tab.messages
+        pooled = self.session_pool.total_bytes
+        text = f"{len(messages):,} msgs, {messages.nbytes / (1024 * 1024):.1f} MB"
+        self.memory_label.configure(text=f"{text} (+{pooled / (1024 * 1024):.1f} MB pooled)" if pooled else text)
+
+    def export_metrics(self, path=None):
+        path = path or filedialog.asksaveasfilename(
+            parent=self, title="Export Metrics", defaultextension=".json", initialfile="metrics.json",
+            filetypes=[("JSON", "*.json"), ("Prometheus text", "*.prom"), ("All files", "*.*")])
+        if not path: return False
+        try: self.metrics.export(path)
+        except OSError as e:
+            messagebox.showerror("Export Error", f"Could not write metrics: {e}", parent=self)
+            return False
+        self.update_status(f"Metrics exported to {os.path.basename(path)}.")
+        return True
+
     def set_input_state(self, state):
         send_final_state = state if self.send_icon and self.api_ready else tk.DISABLED
         self.input_entry.configure(state=state)
         self.send_button.configure(state=send_final_state)
 
-    def send_message_thread(self, user_message):
-        if not self.api_ready or not self.chat:
-            self.message_queue.put(("DISPLAY_MSG", ("API not ready.", "error")))
-            self.message_queue.put(("SET_INPUT_STATE", tk.NORMAL))
-            self.message_queue.put(("STATUS_UPDATE", "API Error!"))
+    async def send_message_async(self, tab, prompt, history, metrics):
+        # history is a snapshot of tab.messages; the exchange is added to the store by
+        # on_reply_finished, on the UI thread, from the Messages the transcript shows.
+        metrics.started = time.perf_counter()
+        if not self.api_ready or not self.model:
+            metrics.outcome = "error"
+            self.post_message("DISPLAY_MSG", ("API not ready.", "error"), tab)
+            self.post_message("STATUS_UPDATE", "API Error!", tab)
             return
 
-        self.message_queue.put(("SET_INPUT_STATE", tk.DISABLED))
-        self.message_queue.put(("STATUS_UPDATE", "Gemini is thinking..."))
-        self.message_queue.put(("DISPLAY_MSG", (user_message, "user")))
-
+        self.post_message("STATUS_UPDATE", "Gemini is thinking...", tab)
+        user_message = prompt.text
+        blocked = False
+        loop = asyncio.get_running_loop() # Blocking steps run in its executor; this loop streams every tab
         try:
-            response = self.chat.send_message(
-                user_message, stream=True, safety_settings=self.safety_settings
-            )
-            full_response = ""
-            self.message_queue.put(("DISPLAY_BOT_PREFIX", None))
-            blocked = False
-            chunk_count = 0
-            for chunk in response:
-                chunk_count += 1
-                if not chunk.parts and hasattr(chunk, 'prompt_feedback') and chunk.prompt_feedback.block_reason:
-                    reason = chunk.prompt_feedback.block_reason
-                    block_msg = f" [Response blocked: {reason}.]"
-                    self.message_queue.put(("STREAM_CHUNK", block_msg))
-                    full_response += block_msg
-                    blocked = True
-                    self.message_queue.put(("STATUS_UPDATE", f"Blocked: {reason}"))
-                    continue
-                try:
-                     chunk_text = chunk.text
-                     self.message_queue.put(("STREAM_CHUNK", chunk_text))
-                     full_response += chunk_text
-                except ValueError: continue
-            if chunk_count > 0:
-                 self.message_queue.put(("MARK_DIRTY", True))
-            self.message_queue.put(("STORE_BOT_RESPONSE", full_response))
-        except Exception as e:
+            retrieved = None
+            if self.retrieval:
+                exclude = {os.path.basename(tab.chat_file)} if tab.chat_file else set() # Already in the context
+                snippets, elapsed = await loop.run_in_executor(None, retrieve_snippets, user_message, exclude, self.retrieval_token_budget)
+                if snippets is None:
+                    self.retrieval = False
+                    self.post_message("DISPLAY_MSG", ("Retrieval from past chats is off: it needs NumPy and SQLite FTS5.", "info"), tab)
+                else:
+                    metrics.retrieval_ms = elapsed * 1000
+                    retrieved = (len(snippets), metrics.retrieval_ms)
+                    if snippets: user_message = attach_snippets(user_message, snippets)
+            context, context_tokens = await loop.run_in_executor(None, tab.context.select, history, user_message)
+            self.post_message("CONTEXT_UPDATE", (context_tokens, tab.context.budget, len(context), len(history), retrieved), tab)
+            cache_key = cached_chunks = None
+            if self.response_cache:
+                cache_key = await loop.run_in_executor(None, ResponseCache.key, self.current_model_name, context, user_message, self.safety_settings)
+                cached_chunks = await loop.run_in_executor(None, self.response_cache.get, cache_key)
+                self.post_message("CACHE_STATS", self.response_cache.stats())
+            if cached_chunks is not None:
+                # Same STREAM_CHUNK path as a live reply, so the UI can't tell the difference
+                metrics.cached = True
+                metrics.on_send()
+                self.post_message("DISPLAY_BOT_PREFIX", metrics, tab)
+                for chunk_text in cached_chunks:
+                    await asyncio.sleep(0) # Lets Stop and the other tabs in between chunks
+                    metrics.on_chunk(chunk_text)
+                    self.post_message("STREAM_CHUNK", (metrics, chunk_text), tab)
+            else:
+                # Send through a throwaway session over the trimmed context
+                send_session = self.model.start_chat(history=api_history(context))
+                waits = []
+                def on_wait(message):
+                    waits.append(message)
+                    self.post_message("STATUS_UPDATE", message, tab)
+                def send():
+                    metrics.on_send()
+                    return send_session.send_message_async(user_message, stream=True, safety_settings=self.safety_settings)
+                response = await self.rate_limiter.call((self.current_model_name, self.api_key), send, on_wait)
+                if waits: self.post_message("STATUS_UPDATE", "Gemini is thinking...", tab)
+                self.post_message("DISPLAY_BOT_PREFIX", metrics, tab)
+                received_chunks = [] if cache_key else None
+                async for chunk in response:
+                    if not chunk.parts and hasattr(chunk, 'prompt_feedback') and chunk.prompt_feedback.block_reason:
+                        reason = chunk.prompt_feedback.block_reason
+                        self.post_message("STREAM_CHUNK", (metrics, f" [Response blocked: {reason}.]"), tab)
+                        blocked = True
+                        self.post_message("STATUS_UPDATE", f"Blocked: {reason}", tab)
+                        continue
+                    try:
+                         chunk_text = chunk.text
+                         metrics.on_chunk(chunk_text)
+                         self.post_message("STREAM_CHUNK", (metrics, chunk_text), tab)
+                         if received_chunks is not None: received_chunks.append(chunk_text)
+                    except ValueError: continue
+                metrics.stream_end = time.perf_counter()
+                if received_chunks and not blocked:
+                    await loop.run_in_executor(None, self.response_cache.put, cache_key, received_chunks)
+                    self.post_message("CACHE_STATS", self.response_cache.stats())
+            metrics.stream_end = metrics.stream_end or time.perf_counter()
+            metrics.outcome = "blocked" if blocked else "ok"
+            if not blocked: self.post_message("STATUS_UPDATE", "Ready.", tab)
+        except Exception as e: # Not CancelledError: Stop lets that through to the engine
             if "API key not valid" in str(e): err_display = "Invalid API Key."
             elif "Quota" in str(e): err_display = "API Quota exceeded."
             elif "timeout" in str(e): err_display = "Request timed out."
             else: err_display = f"{type(e).__name__}."
-            self.message_queue.put(("DISPLAY_MSG", (err_display, "error")))
-            self.message_queue.put(("STATUS_UPDATE", "Error!"))
-            self.message_queue.put(("STORE_BOT_RESPONSE", ""))
-        finally:
-            self.message_queue.put(("SET_INPUT_STATE", tk.NORMAL))
-            current_status_text = self.status_bar.cget("text").split("|")[-1].strip() # Check current status text more directly
-            if "Error!" not in current_status_text and not blocked:
-                 self.message_queue.put(("STATUS_UPDATE", "Ready."))
-            elif not blocked:
-                 self.message_queue.put(("STATUS_UPDATE", current_status_text)) # Refresh status to show dirty state
-
+            metrics.outcome = "error"
+            self.post_message("DISPLAY_MSG", (err_display, "error"), tab)
+            self.post_message("STATUS_UPDATE", "Error!", tab)
+
+    async def compare_reply_async(self, column, prompt, history):
+        # One model's answer in the compare window, rate limited and measured like a chat reply
+        metrics = column.metrics
+        metrics.started = time.perf_counter()
+        model = self.model_pool.get(column.model_name)
+        if model is None:
+            model = self.backend.create_model(column.model_name)
+            self.model_pool.put(column.model_name, model)
+        context_window = ContextWindow(context_budget_for(column.model_name, self.config))
+        context, _ = await asyncio.get_running_loop().run_in_executor(None, context_window.select, history, prompt)
+        session = model.start_chat(history=api_history(context))
+        def send():
+            metrics.on_send()
+            return session.send_message_async(prompt, stream=True, safety_settings=self.safety_settings)
+        response = await self.rate_limiter.call((column.model_name, self.api_key), send,
+                                                lambda message: self.post_message("COMPARE_STATUS", (column, message)))
+        async for chunk in response:
+            if not chunk.parts and hasattr(chunk, 'prompt_feedback') and chunk.prompt_feedback.block_reason:
+                self.post_message("COMPARE_CHUNK", (column, f" [Response blocked: {chunk.prompt_feedback.block_reason}.]"))
+                metrics.outcome = "blocked"
+                continue
+            try: chunk_text = chunk.text
+            except ValueError: continue
+            metrics.on_chunk(chunk_text)
+            self.post_message("COMPARE_CHUNK", (column, chunk_text))
+        metrics.stream_end = time.perf_counter()
+        if metrics.outcome is None: metrics.outcome = "ok"
+
+    def keep_answer(self, tab, prompt, answer, model_name):
+        # A compare window answer joins the tab's history as if it had been sent there
+        for message in (Message('user', prompt), Message('model', answer)):
+            tab.transcript.append(message)
+            tab.messages.append(message)
+        tab.textbox.see(tk.END)
+        tab.dirty = True
+        self.schedule_autosave(tab)
+        self.select_tab(tab)
+        self.update_status(f"Kept the answer from {model_name}.", tab)
+        self.trim_memory()
+
+    def is_live_reply(self, tab, metrics):
+        # Stream messages still queued from a stopped request are dropped
+        return tab.request is not None and metrics is tab.metrics
+
+    def on_reply_finished(self, job):
+        tab, metrics = job.args[0], job.args[3]
+        if job.status == Job.CANCELLED: metrics.outcome = "cancelled"
+        elif job.status == Job.FAILED or metrics.outcome is None: metrics.outcome = "error"
+        if metrics.rendered is None: metrics.rendered = time.perf_counter()
+        self.metrics.record(metrics)
+        self.update_rate_label()
+        if tab.request is not job: return # Stopped: the tab was handed back by stop_generation
+        self.release_tab(tab, job)
+        if tab.closed: return
+        if job.status == Job.FAILED:
+            self.display_message(f"{type(job.error).__name__}.", tag="error", tab=tab)
+            self.update_status("Error!", tab)
+        if tab is self.tab: self.update_speed_label(metrics)
+
+    def release_tab(self, tab, job, stopped=False):
+        # Ends the tab's request on the UI side: the exchange joins the history and input
+        # comes back. Stop does this at once; the job's completion then only records metrics.
+        prompt, metrics = job.args[1], job.args[3]
+        reply, tab.reply = tab.reply, None
+        tab.request = None
+        if tab.closed: return
+        tab.transcript.close_last()
+        # Finished replies join the history; a stopped one only if some of it arrived
+        if (not stopped and metrics.outcome == "ok") or ((stopped or metrics.outcome == "cancelled") and reply is not None and reply.text):
+            tab.messages.append(prompt)
+            tab.messages.append(reply or Message('model'))
+            tab.dirty = True
+            self.schedule_autosave(tab)
+            self.update_status(tab.status, tab)
+            self.trim_memory()
+        if stopped or job.status == Job.CANCELLED: self.update_status("Stopped.", tab)
+        if tab is self.tab:
+            self.stop_button.configure(state=tk.DISABLED)
+            self.set_input_state(tk.NORMAL)
+
+    def stop_generation(self, event=None):
+        job = self.tab.request
+        if job is None or job.cancelled: return
+        self.engine.cancel(job) # Cancels the task, which closes its stream
+        self.release_tab(self.tab, job, stopped=True) # Input is back within this frame
 
     def send_message(self):
+        tab = self.tab
         user_message = self.input_entry.get().strip()
-        if not user_message or self.send_button.cget("state") == tk.DISABLED:
+        if not user_message or self.send_button.cget("state") == tk.DISABLED or tab.request or tab.loading:
             return
         if not self.api_ready:
             self.display_message("API not initialized.", tag="error")
             return
+        prompt = Message('user', user_message)
+        tab.metrics = RequestMetrics(self.current_model_name)
+        tab.request = self.engine.submit(self.send_message_async, tab, prompt, tab.messages.snapshot(), tab.metrics,
+                                         on_complete=self.on_reply_finished)
         self.input_entry.delete(0, tk.END)
-        threading.Thread(target=self.send_message_thread, args=(user_message,), daemon=True).start()
+        tab.transcript.append(prompt)
+        tab.textbox.see(tk.END)
+        self.set_input_state(tk.DISABLED)
+        self.stop_button.configure(state=tk.NORMAL)
+        busy = sum(1 for other in self.tabs.values() if other.request)
+        if busy > self.engine.max_active: self.update_status(f"Waiting: {busy - self.engine.max_active} replies ahead...")
 
     def on_enter_pressed(self, event):
         self.send_message()
 
+    def create_wakeup_pipe(self):
+        # Worker threads never call Tk (under threaded Tcl that waits for the UI thread):
+        # post_message writes a byte to a pipe whose read end Tk watches. Where Tk can't
+        # watch file descriptors (Windows), the UI thread polls queue_wakeup instead.
+        if os.name != "posix" or not hasattr(self.tk, "createfilehandler"):
+            self.after(QUEUE_POLL_MS, self.poll_queue_wakeup)
+            return None
+        reader, writer = os.pipe()
+        os.set_blocking(reader, False)
+        os.set_blocking(writer, False)
+        self.tk.createfilehandler(reader, tk.READABLE, lambda fd, mask: self.on_queue_wakeup())
+        return reader, writer
+
+    def on_queue_wakeup(self):
+        try:
+            while os.read(self.wakeup_pipe[0], 4096): pass
+        except BlockingIOError: pass
+        self.process_message_queue()
+
+    def poll_queue_wakeup(self):
+        if self.queue_wakeup.is_set(): self.process_message_queue()
+        self.after(QUEUE_POLL_MS, self.poll_queue_wakeup)
+
+    def post_message(self, message_type, data=None, tab=None):
+        # Called from any thread, so no Tk calls here
+        self.message_queue.put((message_type, data, tab, time.perf_counter()))
+        if self.queue_wakeup.is_set(): return # A drain is already scheduled
+        self.queue_wakeup.set()
+        if self.wakeup_pipe:
+            try: os.write(self.wakeup_pipe[1], b"\0")
+            except OSError: pass # Full pipe: a wakeup is pending anyway
+
+    def poll_message_queue(self):
+        if not self.message_queue.empty(): self.process_message_queue()
+        self.after(QUEUE_IDLE_POLL_MS, self.poll_message_queue)
+
     def process_message_queue(self):
+        self.queue_wakeup.clear()
+        deadline = time.perf_counter() + self.frame_budget_ms / 1000
+        pending_chunks = {} # Tab or compare column -> chunks, coalesced into a single insert each
         try:
-            while True:
-                message_type, data = self.message_queue.get_nowait()
-                if message_type == "DISPLAY_MSG": self.display_message(data[0], data[1], data[2] if len(data)>2 else True)
-                elif message_type == "STREAM_CHUNK": self.display_stream_chunk(data)
-                elif message_type == "STATUS_UPDATE": self.update_status(data)
+            while time.perf_counter() < deadline:
+                message_type, data, tab, posted = self.message_queue.get_nowait()
+                self.metrics.observe("ui_queue_lag_ms", (time.perf_counter() - posted) * 1000)
+                if tab is not None and tab.closed: continue
+                if message_type == "STREAM_CHUNK":
+                     if self.is_live_reply(tab, data[0]): pending_chunks.setdefault(tab, []).append(data[1])
+                     continue
+                if message_type == "COMPARE_CHUNK":
+                     pending_chunks.setdefault(data[0], []).append(data[1])
+                     continue
+                if pending_chunks:
+                     self.flush_stream_chunks(pending_chunks)
+                tab = tab or self.tab
+                if message_type == "DISPLAY_MSG": self.display_message(data[0], data[1], data[2] if len(data)>2 else True, tab=tab)
+                elif message_type == "STATUS_UPDATE": self.update_status(data, tab)
                 elif message_type == "SET_INPUT_STATE": self.set_input_state(data)
+                elif message_type == "CONTEXT_UPDATE":
+                     tab.context_info = data
+                     if tab is self.tab: self.update_context_label(data)
+                elif message_type == "RATE_STATS": self.update_rate_label()
+                elif message_type == "CACHE_STATS": self.cache_label.configure(text=f"Cache: {data['hits']} hits / {data['misses']} misses")
                 elif message_type == "PROMPT_API_KEY": self.prompt_for_api_key()
                 elif message_type == "DISPLAY_BOT_PREFIX":
-                     self.chat_display.configure(state=tk.NORMAL)
-                     self.chat_display.insert(tk.END, f"Gemini: ", "bot")
-                     self.chat_display.configure(state=tk.DISABLED)
-                elif message_type == "STORE_BOT_RESPONSE":
-                     self.last_bot_response = data
-                     if data and not (data.strip().startswith("[") and data.strip().endswith("]")):
-                         self.chat_display.configure(state=tk.NORMAL)
-                         self.chat_display.insert(tk.END, "\n\n")
-                         self.chat_display.configure(state=tk.DISABLED)
-                         self.chat_display.see(tk.END)
-                elif message_type == "MARK_DIRTY":
-                     self.chat_is_dirty = data
-                     self.update_status(self.status_bar.cget("text").split("|")[-1].strip())
+                     if not self.is_live_reply(tab, data): continue
+                     tab.reply = Message('model')
+                     tab.transcript.append(tab.reply, streaming=True)
+                     tab.textbox.see(tk.END)
+                elif message_type == "LOAD_BATCH": self.on_load_batch(tab, *data)
+                elif message_type == "COMPARE_STATUS":
+                     if not data[0].closed: data[0].stats_label.configure(text=data[1])
+                elif message_type == "REFRESH_CHAT_LIST": self.load_chat_list()
+                elif message_type == "JOB_DONE": data.on_complete(data)
                 elif message_type == "UPDATE_TITLE":
-                      self.title(f"{APP_NAME} ({self.current_model_name})")
+                      backend = self.config.get(SETTINGS_SECTION, BACKEND_OPTION, fallback=DEFAULT_BACKEND)
+                      suffix = "" if backend == DEFAULT_BACKEND else f" [{backend}]"
+                      self.title(f"{APP_NAME} ({self.current_model_name}){suffix}")
         except queue.Empty: pass
-        finally: self.after(100, self.process_message_queue)
+        finally:
+            if pending_chunks: self.flush_stream_chunks(pending_chunks)
+            if not self.message_queue.empty() and not self.queue_wakeup.is_set():
+                # Frame budget exhausted: yield to input handling, continue on the next frame
+                self.queue_wakeup.set()
+                self.after(1, self.process_message_queue)
+
+    def flush_stream_chunks(self, pending_chunks):
+        for target, chunks in pending_chunks.items():
+            if isinstance(target, CompareColumn):
+                if self.compare_window: self.compare_window.on_chunk(target, "".join(chunks))
+                continue
+            self.display_stream_chunk("".join(chunks), target)
+            if target.metrics:
+                target.metrics.on_render()
+                if target is self.tab: self.update_speed_label(target.metrics)
+        pending_chunks.clear()
 
     def load_chat_list(self):
-        for widget in self.chat_list_frame.winfo_children():
-            widget.destroy()
-        chat_files = get_chat_files()
-        if not chat_files:
-            no_chats_label = ctk.CTkLabel(self.chat_list_frame, text="No saved chats", text_color="gray", font=self.chatlist_font)
-            no_chats_label.grid(row=0, column=0, pady=5, sticky="ew")
+        self.chat_list.set_items(get_chat_files())
+
+    def load_archived_chats(self):
+        catalog = get_catalog()
+        try: filenames = catalog.list_archived(len(self.chat_list.archived)) if catalog else []
+        except sqlite3.Error: filenames = []
+        self.chat_list.add_archived(filenames, has_more=len(filenames) == ARCHIVE_PAGE_SIZE)
+
+    def search_chats(self, event=None):
+        query = self.search_entry.get().strip()
+        if not query: return
+        catalog = get_catalog()
+        if not catalog or not catalog.search_enabled:
+            self.update_status("Search unavailable (SQLite FTS5 missing).")
             return
-        for i, filename in enumerate(chat_files):
-            file_path = os.path.join(CHATS_DIR, filename)
-            display_name = os.path.splitext(filename)[0].replace('_', ' ')
-            chat_item_frame = ctk.CTkFrame(self.chat_list_frame, fg_color="transparent")
-            chat_item_frame.grid(row=i, column=0, pady=(0, 2), sticky="ew")
-            chat_item_frame.grid_columnconfigure(0, weight=1)
-            load_button = ctk.CTkButton(
-                chat_item_frame, text=display_name, font=self.chatlist_font, anchor="w",
-                fg_color="transparent", hover_color=("#dbdbdb", "#2b2b2b"),
-                command=lambda p=file_path: self.load_chat(p)
-            )
-            load_button.grid(row=0, column=0, padx=(5,0), sticky="ew")
-            delete_button = ctk.CTkButton(
-                chat_item_frame, text="X", font=self.chatlist_font, width=20, height=20,
-                fg_color="transparent", hover_color="#AA0000", text_color=("#D2691E","#CD5C5C"),
-                command=lambda p=file_path, w=chat_item_frame: self.delete_chat(p, w)
-            )
-            delete_button.grid(row=0, column=1, padx=(0,5))
+        try: results = catalog.search(query)
+        except sqlite3.Error:
+            self.update_status("Invalid search query.")
+            return
+        if self.search_window is None or not self.search_window.winfo_exists():
+            self.search_window = SearchResultsWindow(self)
+        self.search_window.show_results(query, results)
+
+    def open_search_result(self, filename, turn):
+        file_path = os.path.join(CHATS_DIR, filename)
+        self.load_chat(file_path) # Selects the tab if the chat is already open
+        tab = self.find_tab(file_path)
+        if tab and tab.loading: tab.show_when_loaded = turn
+        elif tab: self.show_turn(tab, turn)
+
+    def show_turn(self, tab, turn):
+        # Turns count the chat's messages, as the catalog does; the transcript has more entries
+        if not 0 <= turn < len(tab.messages): return
+        index = tab.transcript.index_of(tab.messages[turn], start=turn)
+        if index is not None: tab.transcript.show(index, highlight=True)
 
     def prompt_chat_title(self, default=""):
         title = simpledialog.askstring("Save Chat", "Enter a title for this chat:", initialvalue=default, parent=self)
         return title
 
     def save_current_chat(self):
-        if not self.api_ready or not self.chat or not self.chat.history:
+        tab = self.tab
+        if tab.loading:
+             self.update_status("Still loading.")
+             return
+        if not tab.messages:
              messagebox.showinfo("Cannot Save", "No chat history to save.", parent=self)
              return
-        first_user_message = next((msg.parts[0].text for msg in self.chat.history if msg.role == 'user' and msg.parts), None)
+        first_user_message = next((msg.text for msg in tab.messages if msg.role == 'user'), None)
         suggested_title = ""
         if first_user_message:
             suggested_title = "".join(c for c in first_user_message[:30] if c.isalnum() or c in (' ', '_')).strip()
         if not suggested_title: suggested_title = f"Chat_{datetime.datetime.now():%Y%m%d_%H%M%S}"
-        filename_to_save = os.path.basename(self.current_chat_file) if self.current_chat_file else None
+        filename_to_save = os.path.basename(tab.chat_file) if tab.chat_file else None
         title_to_use = os.path.splitext(filename_to_save)[0] if filename_to_save else suggested_title
         user_title = self.prompt_chat_title(default=title_to_use)
         if not user_title: return
         safe_filename = "".join(c for c in user_title if c.isalnum() or c in (' ', '_', '-')).strip()
         if not safe_filename: safe_filename = f"Chat_{datetime.datetime.now():%Y%m%d_%H%M%S}"
-        safe_filename += ".json"
+        safe_filename += CHAT_EXTENSION
         file_path = os.path.join(CHATS_DIR, safe_filename)
-        if os.path.exists(file_path) and file_path != self.current_chat_file:
+        open_tab = self.find_tab(file_path)
+        if open_tab and open_tab is not tab:
+             messagebox.showinfo("Cannot Save", f"'{user_title}' is open in another tab.", parent=self)
+             return
+        if chat_exists(file_path) and file_path != tab.chat_file:
              if not messagebox.askyesno("Overwrite?", f"Overwrite '{user_title}'?", parent=self): return
-        if save_chat_to_file(self.chat.history, file_path):
-            self.current_chat_file = file_path
-            self.chat_is_dirty = False
+        self.session_pool.pop(file_path) # Its pooled copy is about to be out of date
+        history = tab.messages
+        append_from = tab.saved_message_count if file_path == tab.chat_file else None
+        if save_chat_to_file(history, file_path, append_from=append_from):
+            legacy_filename = os.path.splitext(safe_filename)[0] + LEGACY_CHAT_EXTENSION
+            if os.path.join(CHATS_DIR, legacy_filename) == tab.chat_file:
+                self.chat_list.remove(legacy_filename) # Migrated to the append-only format by the writer
+            self.cancel_autosave(tab)
+            tab.chat_file = file_path
+            tab.saved_message_count = len(history)
+            tab.dirty = False
+            self.rename_tab(tab, os.path.splitext(safe_filename)[0])
             self.update_status("Chat saved.")
-            self.load_chat_list()
+            self.chat_list.insert(safe_filename) # Saved chat moves to the top, other rows untouched
         else: self.update_status("Save failed.")
 
-    def _confirm_discard_changes(self):
-        if self.chat_is_dirty:
+    def schedule_autosave(self, tab):
+        if not tab.chat_file or self.autosave_delay_ms <= 0: return
+        self.cancel_autosave(tab)
+        tab.autosave_job = self.after(self.autosave_delay_ms, lambda: self.autosave(tab))
+
+    def cancel_autosave(self, tab):
+        if tab.autosave_job:
+            self.after_cancel(tab.autosave_job)
+            tab.autosave_job = None
+
+    def autosave(self, tab):
+        tab.autosave_job = None
+        if not tab.dirty or not tab.chat_file or tab.closed: return
+        history = tab.messages
+        file_path = chat_save_path(tab.chat_file)
+        if save_chat_to_file(history, file_path, append_from=tab.saved_message_count):
+            if file_path != tab.chat_file: # Migrated to the append-only format by the writer
+                self.chat_list.remove(os.path.basename(tab.chat_file))
+                tab.chat_file = file_path
+            tab.saved_message_count = len(history)
+            tab.dirty = False
+            self.update_status("Autosaved.", tab)
+            self.chat_list.insert(os.path.basename(tab.chat_file))
+
+    def on_close(self):
+        for tab in self.tabs.values():
+            if tab.autosave_job:
+                self.cancel_autosave(tab)
+                self.autosave(tab)
+        metrics_file = self.config.get(SETTINGS_SECTION, METRICS_FILE_OPTION, fallback="").strip()
+        if metrics_file:
+            try: self.metrics.export(os.path.expanduser(metrics_file))
+            except OSError: pass
+        flush_chat_writes(timeout=5)
+        if self.watchdog: self.watchdog.stop()
+        if self.wakeup_pipe: self.tk.deletefilehandler(self.wakeup_pipe[0])
+        self.destroy()
+
+    def _confirm_discard_changes(self, tab):
+        if tab.autosave_job:
+            self.cancel_autosave(tab)
+            self.autosave(tab) # Saved chats don't need to ask, just write the pending turns now
+        if tab.dirty:
             return messagebox.askyesno("Unsaved Changes", "Discard unsaved changes?", icon='warning', parent=self)
         return True
 
     def load_chat(self, file_path):
-        if not self._confirm_discard_changes(): return
+        open_tab = self.find_tab(file_path)
+        if open_tab:
+            self.select_tab(open_tab)
+            return
+        pooled = self.session_pool.pop(file_path)
+        if pooled:
+            messages, entries = pooled
+            tab = self.tab if self.tab.is_empty() else self.new_tab()
+            tab.messages = messages
+            tab.context.reset()
+            tab.context_info = None
+            tab.transcript.load(entries)
+            self.open_chat_file(tab, file_path, len(messages))
+            self.trim_memory()
+            return
+        # Chats open next to each other; only an untouched tab, or one still loading, is reused
+        tab = self.tab if self.tab.is_empty() or self.tab.loading else self.new_tab()
+        if tab.loading: tab.loading.cancel() # Clicked another chat before this one finished
+        tab.transcript.clear()
+        tab.show_when_loaded = None
+        tab.loading = self.executor.submit(self.load_chat_thread, tab, file_path,
+                                           priority=JOB_PRIORITY_HIGH, on_complete=self.on_chat_loaded)
+        self.open_chat_file(tab, file_path, 0)
         self.update_status(f"Loading {os.path.basename(file_path)}...")
-        loaded_history = load_chat_from_file(file_path)
-        if loaded_history is not None:
-            self.chat_display.configure(state=tk.NORMAL)
-            self.chat_display.delete("1.0", tk.END)
-            self.chat_display.configure(state=tk.DISABLED)
-            if self.api_ready and self.model:
-                try:
-                     formatted_history_for_api = []
-                     for item in loaded_history:
-                         if 'content' in item: formatted_history_for_api.append({'role': item['role'], 'parts': [{'text': item['content']}]})
-                         else: formatted_history_for_api.append(item)
-                     self.chat = self.model.start_chat(history=formatted_history_for_api)
-                except Exception as e:
-                     messagebox.showerror("Load Error", f"Could not restart chat session: {e}", parent=self)
-                     self.new_chat(confirm_discard=False)
-                     return
-                self.chat_display.configure(state=tk.NORMAL)
-                for msg in self.chat.history:
-                     role = getattr(msg, 'role', 'unknown')
-                     content = ""
-                     try: content = "".join(part.text for part in msg.parts if hasattr(part, 'text'))
-                     except AttributeError:
-                         if isinstance(msg, dict) and 'content' in msg: content = msg['content']
-                         elif isinstance(msg, dict) and 'parts' in msg: content = "".join(part.get('text', '') for part in msg['parts'] if isinstance(part, dict))
-                     if content: self.display_message(content, tag=role, append_newlines=True)
-                self.chat_display.configure(state=tk.DISABLED)
-                self.current_chat_file = file_path
-                self.chat_is_dirty = False
-                self.update_status("Chat loaded.")
-                self.input_entry.focus()
-            else:
-                self.update_status("API not ready.")
-                self.display_message("API not ready. Cannot load context.", tag="error")
-        else: self.update_status("Load failed.")
 
-    def delete_chat(self, file_path, item_widget):
+    def load_chat_thread(self, tab, file_path):
+        # Parses newest messages first and hands them over in batches, so the tab shows
+        # the end of the chat at once and older messages fill in behind it.
+        job = self.executor.current_job
+        data = read_chat_bytes(file_path)
+        if file_path.endswith(CHAT_EXTENSION):
+            lines = [line for line in data.split(b"\n") if line.strip()]
+        else:
+            lines = json.loads(data) # Legacy whole-array format
+        del data
+        total = len(lines)
+        messages = [None] * total
+        end = total
+        while end > 0:
+            if job.cancelled: return None
+            start = max(0, end - (TRANSCRIPT_PAGE_SIZE if end == total else LOAD_BATCH_SIZE))
+            entries = []
+            for i in range(start, end):
+                item = lines[i]
+                if isinstance(item, bytes):
+                    try: item = json.loads(item)
+                    except json.JSONDecodeError: # Torn write from a crash; dropped once loaded
+                        entries.append([])
+                        continue
+                messages[i] = Message(item['role'], item['content'])
+                entries.append(messages[i]) # The transcript shows the store's own objects
+                lines[i] = None
+            self.post_message("LOAD_BATCH", (job, start, entries, total), tab)
+            end = start
+        if job.cancelled: return None
+        return MessageStore(msg for msg in messages if msg is not None)
+
+    def on_load_batch(self, tab, job, start, entries, total):
+        if job is not tab.loading: return # Superseded by a later load in the same tab
+        if start + len(entries) == total: tab.transcript.load(entries, total) # Newest page first
+        else: tab.transcript.fill(start, entries)
+        if start: self.update_status(f"Loading {os.path.basename(tab.chat_file)}... {total - start:,}/{total:,}", tab)
+
+    def on_chat_loaded(self, job):
+        tab = job.args[0]
+        if job is not tab.loading or tab.closed: return
+        tab.loading = None
+        if job.status == Job.FAILED:
+            messagebox.showerror("Load Error", f"Failed to load chat: {job.error}", parent=self)
+            self.new_chat(confirm_discard=False, tab=tab)
+            self.update_status("Load failed.", tab)
+            return
+        tab.messages = job.result
+        if len(tab.transcript.entries) != len(tab.messages):
+            # Torn lines were skipped, as the catalog skips them; drop their placeholders so
+            # transcript indexes match the store and the catalog's turns again
+            tab.transcript.load(tab.messages)
+        tab.saved_message_count = len(tab.messages)
+        tab.context.reset()
+        tab.context_info = None
+        if tab is self.tab: self.update_context_label(None)
+        self.trim_memory()
+        self.update_status("Chat loaded.", tab)
+        if tab is self.tab: self.set_input_state(tk.NORMAL)
+        if tab.show_when_loaded is not None:
+            self.show_turn(tab, tab.show_when_loaded)
+            tab.show_when_loaded = None
+
+    def open_chat_file(self, tab, file_path, message_count):
+        tab.chat_file = file_path
+        tab.saved_message_count = message_count
+        tab.dirty = False
+        self.rename_tab(tab, os.path.splitext(os.path.basename(file_path))[0])
+        self.select_tab(tab)
+        self.update_status("Chat loaded.")
+
+    def delete_chat(self, file_path):
         filename = os.path.basename(file_path)
         if messagebox.askyesno("Delete Chat?", f"Delete '{filename}'?", icon='warning', parent=self):
             if delete_chat_file(file_path):
-                item_widget.destroy()
+                self.session_pool.pop(file_path)
+                self.chat_list.remove(filename)
                 self.update_status(f"Deleted {filename}.")
-                if self.current_chat_file == file_path:
-                     self.new_chat(confirm_discard=False)
+                tab = self.find_tab(file_path)
+                if tab and tab.request: # Keep the streaming reply; the tab just no longer has a file
+                     tab.chat_file = None
+                     tab.dirty = True
+                     self.update_status(f"Deleted {filename}.", tab)
+                elif tab: self.new_chat(confirm_discard=False, tab=tab)
             else: self.update_status("Delete failed.")
 
-    def new_chat(self, confirm_discard=True):
-        if confirm_discard and not self._confirm_discard_changes(): return
-        self.chat_display.configure(state=tk.NORMAL)
-        self.chat_display.delete("1.0", tk.END)
-        self.chat_display.configure(state=tk.DISABLED)
-        self.last_bot_response = ""
-        self.current_chat_file = None
-        self.chat_is_dirty = False
-        if self.api_ready and self.model:
-            try:
-                self.chat = self.model.start_chat(history=[])
-                self.update_status("New chat started.")
-            except Exception as e:
-                 self.update_status("Error starting new chat.")
-                 self.display_message("Error starting new chat session.", tag="error")
-        else: self.update_status("New chat (API not ready).")
-        self.input_entry.focus()
+    def new_chat(self, confirm_discard=True, tab=None):
+        tab = tab or self.tab
+        if tab.request: # Never reset a tab under a streaming reply; start the new chat beside it
+            self.new_tab()
+            return
+        if confirm_discard and not self._confirm_discard_changes(tab): return
+        if tab.loading:
+            tab.loading.cancel()
+            tab.loading = None
+        self.cancel_autosave(tab)
+        if tab.chat_file and chat_exists(tab.chat_file): self.pool_session(tab)
+        tab.transcript.clear()
+        tab.messages = MessageStore()
+        tab.context.reset()
+        tab.context_info = None
+        if tab is self.tab: self.update_context_label(None)
+        tab.chat_file = None
+        tab.saved_message_count = 0
+        tab.dirty = False
+        self.rename_tab(tab, "New Chat")
+        self.trim_memory()
+        self.update_status("New chat started." if self.api_ready else "New chat (API not ready).", tab)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=APP_NAME)
+    parser.add_argument("--startup-profile", action="store_true", help="print the time taken by each startup stage to stderr")
+    parser.add_argument("--mock-server", action="store_true", help="run only the local mock streaming server (for offline load tests)")
+    parser.add_argument("--mock-port", type=int, default=DEFAULT_MOCK_PORT, help="port for --mock-server")
+    for option, default in DEFAULT_MOCK_PROFILE.items():
+        parser.add_argument(f"--{option.replace('_', '-')}", type=type(default), default=None, help=f"mock server {option} (default from [{MOCK_SECTION}])")
+    parser.add_argument("--batch", metavar="PROMPTS_JSONL", help="run prompts from a JSONL file without the GUI")
+    parser.add_argument("--output", metavar="RESULTS_JSONL", help="results file for --batch (default: <prompts>.results.jsonl)")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_BATCH_CONCURRENCY, help="concurrent requests for --batch")
+    parser.add_argument("--model", choices=AVAILABLE_MODELS, help="model for --batch (default from config)")
+    parser.add_argument("--benchmark", nargs="?", const="-", metavar="RESULTS_JSON", help="time storage, sidebar and transcript paths on synthetic chats and write JSON (stdout by default)")
+    parser.add_argument("--baseline", metavar="BASELINE_JSON", help="earlier --benchmark results to check for regressions")
+    parser.add_argument("--benchmark-chats", default=",".join(map(str, BENCHMARK_CHAT_COUNTS)), help="comma-separated chat counts for --benchmark")
+    parser.add_argument("--benchmark-turns", default=",".join(map(str, BENCHMARK_TURN_COUNTS)), help="comma-separated turn counts for --benchmark")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per --benchmark measurement (the median is reported)")
+    args = parser.parse_args()
+    if args.batch:
+        sys.exit(run_batch(args.batch, args.output, max(1, args.concurrency), args.model))
+    if args.benchmark:
+        sys.exit(run_benchmarks(args.benchmark, [int(n) for n in args.benchmark_chats.split(",") if n],
+                                [int(n) for n in args.benchmark_turns.split(",") if n], max(1, args.repeat), args.baseline))
+    if args.mock_server:
+        profile = mock_profile(load_config())
+        profile.update({option: getattr(args, option) for option in DEFAULT_MOCK_PROFILE if getattr(args, option) is not None})
+        server = MockServer(port=args.mock_port, **profile)
+        print(f"Mock server listening on {server.url} with {profile}", flush=True)
+        try: server.serve_forever()
+        except KeyboardInterrupt: pass
+        sys.exit(0)
+    startup_profile.enabled = args.startup_profile
+    startup_profile.record("imports", STARTUP_T0)
     ensure_config_dir()
     ensure_chats_dir()
     app = GeminiChatApp()
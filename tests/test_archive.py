@@ -0,0 +1,89 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+try:
+    import aichatgui
+except ImportError: # customtkinter is not installed
+    aichatgui = None
+
+
+@unittest.skipIf(aichatgui is None, "aichatgui needs customtkinter")
+class ChatArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        aichatgui.use_data_dir(self.directory)
+
+    def tearDown(self):
+        aichatgui.flush_chat_writes(timeout=5)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def write_chat(self, filename, age_days):
+        path = os.path.join(aichatgui.CHATS_DIR, filename)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'role': 'user', 'content': 'hello'}) + "\n")
+            f.write(json.dumps({'role': 'model', 'content': 'hi there'}) + "\n")
+        modified = time.time() - age_days * 86400
+        os.utime(path, (modified, modified))
+        return path
+
+    def restart(self):
+        aichatgui.use_data_dir(self.directory) # Fresh catalog connection and archive reader
+        aichatgui.reconcile_chat_catalog()
+
+    def archive(self, path):
+        aichatgui.reconcile_chat_catalog()
+        aichatgui.archive_old_chats(30)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(aichatgui.get_catalog().list_archived(), [os.path.basename(path)])
+
+    def test_deleted_archived_chat_stays_deleted_after_restart(self):
+        path = self.write_chat("Old.jsonl", age_days=60)
+        self.archive(path)
+        self.assertTrue(aichatgui.delete_chat_file(path))
+        self.assertFalse(aichatgui.chat_exists(path))
+
+        self.restart()
+        self.assertEqual(aichatgui.get_catalog().list_archived(), [])
+        self.assertFalse(aichatgui.chat_exists(path))
+
+        aichatgui.archive_old_chats(30) # The next run drops the member and its tombstone
+        self.assertFalse(aichatgui.get_archive().contains("Old.jsonl"))
+        self.assertEqual(aichatgui.get_catalog().list_deleted(), [])
+        self.restart()
+        self.assertEqual(aichatgui.get_catalog().list_archived(), [])
+
+    def test_deleted_chat_with_stale_member_stays_deleted_after_restart(self):
+        path = self.write_chat("Old.jsonl", age_days=60)
+        self.archive(path)
+        records = aichatgui.load_chat_from_file(path)
+        aichatgui.save_chat_to_file(records, path) # Live again; the member is now stale
+        aichatgui.flush_chat_writes(timeout=5)
+        self.assertEqual(aichatgui.get_catalog().list_files(), ["Old.jsonl"])
+        self.assertTrue(aichatgui.delete_chat_file(path))
+
+        self.restart()
+        self.assertEqual(aichatgui.get_catalog().list_files(), [])
+        self.assertEqual(aichatgui.get_catalog().list_archived(), [])
+        self.assertFalse(aichatgui.chat_exists(path))
+
+    def test_chat_saved_while_archiving_stays_live(self):
+        path = self.write_chat("Old.jsonl", age_days=60)
+        aichatgui.reconcile_chat_catalog()
+        archive = aichatgui.get_archive()
+        add = archive.add
+        def add_then_save(file_paths, keep):
+            add(file_paths, keep)
+            records = aichatgui.load_chat_from_file(path) + [{'role': 'user', 'content': 'one more'}]
+            aichatgui.save_chat_to_file(records, path, append_from=2) # Opened and autosaved meanwhile
+        archive.add = add_then_save
+        self.assertEqual(aichatgui.archive_old_chats(30), 0)
+        self.assertEqual(len(aichatgui.load_chat_from_file(path)), 3)
+        self.assertEqual(aichatgui.get_catalog().list_files(), ["Old.jsonl"])
+
+
+if __name__ == "__main__":
+    unittest.main()
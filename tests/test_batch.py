@@ -0,0 +1,54 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+try:
+    import aichatgui
+except ImportError: # customtkinter is not installed
+    aichatgui = None
+
+
+@unittest.skipIf(aichatgui is None, "aichatgui needs customtkinter")
+class BatchModeTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.load_config = aichatgui.load_config
+        def load_mock_config():
+            config = aichatgui.configparser.ConfigParser()
+            config[aichatgui.API_SECTION] = {aichatgui.API_KEY_OPTION: ''}
+            config[aichatgui.SETTINGS_SECTION] = {aichatgui.BACKEND_OPTION: 'mock', aichatgui.MOCK_URL_OPTION: ''}
+            config[aichatgui.MOCK_SECTION] = {'ttft_ms': '0', 'tokens_per_sec': '10000', 'response_tokens': '5'}
+            return config
+        aichatgui.load_config = load_mock_config
+
+    def tearDown(self):
+        aichatgui.load_config = self.load_config
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def run_batch(self, lines):
+        prompts_path = os.path.join(self.directory, "prompts.jsonl")
+        with open(prompts_path, 'w', encoding='utf-8') as f: f.write("\n".join(lines) + "\n")
+        outcome = {}
+        thread = threading.Thread(target=lambda: outcome.update(status=aichatgui.run_batch(prompts_path, concurrency=1)), daemon=True)
+        thread.start()
+        thread.join(timeout=30)
+        self.assertFalse(thread.is_alive(), "batch run hung")
+        with open(os.path.splitext(prompts_path)[0] + ".results.jsonl", 'r', encoding='utf-8') as f:
+            return outcome['status'], [json.loads(line) for line in f]
+
+    def test_bad_items_get_error_results(self):
+        lines = ['{"id": "a"}', '{"id": "b", "prompt": 3}', '{not json', '42', '{"id": "c", "history": {}, "prompt": "hi"}',
+                 '"hello"', '{"id": "d"}']
+        status, results = self.run_batch(lines)
+        self.assertEqual(status, 1)
+        self.assertEqual(len(results), len(lines))
+        failed = {json.dumps(result['id']) for result in results if result['error']}
+        self.assertEqual(failed, {'"a"', '"b"', '3', '4', '"c"', '"d"'})
+        self.assertTrue(next(result for result in results if result['id'] == 6)['response'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+try:
+    import aichatgui
+except ImportError: # customtkinter is not installed
+    aichatgui = None
+
+
+@unittest.skipIf(aichatgui is None, "aichatgui needs customtkinter")
+class LegacyChatTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        aichatgui.use_data_dir(self.directory)
+        self.records = [{'role': 'user', 'content': 'hello'}, {'role': 'model', 'content': 'hi there'}]
+        self.legacy_path = os.path.join(aichatgui.CHATS_DIR, "Old.json")
+        self.log_path = os.path.join(aichatgui.CHATS_DIR, "Old.jsonl")
+        with open(self.legacy_path, 'w', encoding='utf-8') as f: json.dump(self.records, f)
+
+    def tearDown(self):
+        aichatgui.flush_chat_writes(timeout=5)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def autosave(self, path):
+        records = aichatgui.load_chat_from_file(path) + [{'role': 'user', 'content': 'one more'}]
+        aichatgui.save_chat_to_file(records, path, append_from=2) # What autosave does after one turn
+        aichatgui.flush_chat_writes(timeout=5)
+
+    def restart(self):
+        aichatgui.use_data_dir(self.directory)
+        aichatgui.reconcile_chat_catalog()
+
+    def test_append_to_legacy_chat_migrates_it(self):
+        aichatgui.reconcile_chat_catalog()
+        self.autosave(self.legacy_path)
+        self.assertFalse(os.path.exists(self.legacy_path))
+        self.assertEqual(len(aichatgui.read_chat_records(self.log_path)), 3)
+        self.restart()
+        self.assertEqual(aichatgui.get_catalog().list_files(), ["Old.jsonl"])
+
+    def test_save_of_archived_legacy_chat_migrates_it(self):
+        modified = time.time() - 60 * 86400
+        os.utime(self.legacy_path, (modified, modified))
+        aichatgui.reconcile_chat_catalog()
+        aichatgui.archive_old_chats(30)
+        self.assertFalse(os.path.exists(self.legacy_path))
+        self.autosave(self.legacy_path)
+        self.assertEqual(len(aichatgui.read_chat_records(self.log_path)), 3)
+        self.assertFalse(aichatgui.chat_exists(self.legacy_path))
+        self.restart()
+        self.assertEqual(aichatgui.get_catalog().list_files(), ["Old.jsonl"])
+        self.assertEqual(aichatgui.get_catalog().list_archived(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()